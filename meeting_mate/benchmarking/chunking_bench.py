@@ -0,0 +1,90 @@
+from time import time
+from bs4 import BeautifulSoup
+import markdownify
+import re
+from argparse import ArgumentParser
+from meeting_mate.ingest.sections import split_sections, getHeaderInfo, generate_checksum
+
+# the prettify/extract loop chunk_doc used before split_sections, kept as the baseline
+def legacy_create_chunk(last_header, header, title, date, calendar_link):
+    chunk = last_header.prettify()
+    sibling = None
+    while True:
+        sibling = last_header.find_next_sibling()
+        if sibling and sibling!=header:
+            chunk += sibling.prettify()
+            sibling.extract()
+        else:
+            break
+
+    chunk = "<html><body>"+chunk+"</body></html>"
+    asMarkdown = markdownify.markdownify(chunk)
+    asMarkdown = re.sub(r'\n+', '\n', asMarkdown)
+    asMarkdown = f"Document title: {title} \n\n{asMarkdown}"
+
+    return {"html": chunk,
+            "checksum": generate_checksum(asMarkdown),
+            "markdown": asMarkdown,
+            "date": date,
+            "calendar_link": calendar_link}
+
+def legacy_split_sections(html, title):
+    parsed = BeautifulSoup(html, "html.parser")
+    headers = parsed.findAll("h2")
+
+    chunks = []
+    last_header = None
+
+    for header in headers:
+        header_info = getHeaderInfo(header)
+        if header_info:
+            date, calendar_link = header_info
+            if last_header:
+                chunks.append(legacy_create_chunk(last_header, header, title, date, calendar_link))
+
+            last_header = header
+
+    if last_header:
+        chunks.append(legacy_create_chunk(last_header, None, title, date, calendar_link))
+
+    return chunks
+
+def synthetic_doc(sections:int)->str:
+    # roughly what mammoth produces for a google meeting notes doc
+    html = "<p><strong>Running notes</strong></p>"
+    for i in range(sections):
+        day = i % 28 + 1
+        html += (f'<h2>May {day}, 2024 | <a href="https://www.google.com/calendar/event?eid={i}">Sync with Acme</a></h2>'
+                 f"<p>Attendees: <a href=\"mailto:john@acme.com\">John Doe</a>, Jane Doe</p>"
+                 f"<h3>Notes</h3>"
+                 f"<ul><li>Acme &amp; MongoDB discussed the <em>migration</em> timeline #{i}</li>"
+                 f"<li>Go-live planned in <strong>6 months</strong><ul><li>needs sign-off</li></ul></li></ul>"
+                 f"<h2>Action items</h2>"
+                 f"<ol><li>John to send requirements</li><li>Jane to set up a follow-up</li></ol>"
+                 f"<table><tr><td>Owner</td><td>Due</td></tr><tr><td>John</td><td>Friday</td></tr></table>")
+    return html
+
+def bench(fn, html, title, runs):
+    start = time()
+    for _ in range(runs):
+        result = fn(html, title)
+    return (time() - start) / runs, result
+
+if __name__ == "__main__":
+    args = ArgumentParser()
+    args.add_argument("-s", "--sections", type=int, default=500, help="Number of dated sections in the synthetic document")
+    args.add_argument("-r", "--runs", type=int, default=3, help="Number of runs per implementation")
+    args = args.parse_args()
+
+    html = synthetic_doc(args.sections)
+    title = "Acme meeting notes"
+
+    legacy_took, legacy = bench(legacy_split_sections, html, title, args.runs)
+    took, sections = bench(split_sections, html, title, args.runs)
+
+    assert [chunk["checksum"] for chunk in legacy] == [section["checksum"] for section in sections], "Checksums differ"
+    assert [chunk["date"] for chunk in legacy] == [section["date"] for section in sections], "Dates differ"
+
+    print(f"{args.sections} sections, {len(html)} bytes of html")
+    print(f"legacy prettify/extract loop: {legacy_took:.3f}s")
+    print(f"split_sections:               {took:.3f}s ({legacy_took/took:.1f}x)")
@@ -0,0 +1,77 @@
+from collections import defaultdict
+from math import ceil
+from time import time
+from argparse import ArgumentParser
+import numpy as np
+from sklearn.preprocessing import normalize
+from sklearn.cluster import AgglomerativeClustering, KMeans
+from meeting_mate.llm.clustering import cluster_labels
+
+# the sklearn agglomerative + kmeans split loop _5_cluster_facts used before llm/clustering, kept as the baseline
+def legacy_kmeans(values, embeddings, n_clusters=2):
+    norm_embeddings = normalize(embeddings)
+    clustering = KMeans(n_clusters=n_clusters, random_state=0, n_init='auto')
+    clustering.fit(norm_embeddings)
+
+    clusters = defaultdict(list)
+    for index, (label, doc) in enumerate(zip(clustering.labels_, values)):
+        clusters[str(label)].append({"doc": doc, "embedding": embeddings[index]})
+
+    return clusters
+
+def legacy_agglomerative(values, embeddings, distance_threshold=0.5, max_size=10):
+    norm_embeddings = normalize(embeddings)
+    clustering = AgglomerativeClustering(metric='cosine', linkage='average', distance_threshold=distance_threshold, n_clusters=None)
+    clustering.fit(norm_embeddings)
+
+    clusters = defaultdict(list)
+    for index, (label, doc) in enumerate(zip(clustering.labels_, values)):
+        clusters[str(label)].append({"doc": doc, "embedding": embeddings[index]})
+
+    clusters = [cluster for cluster in clusters.values()]
+
+    for cluster in clusters:
+        if len(cluster) > max_size:
+            n_subclusters = ceil(len(cluster) / max_size)
+            subclusters = legacy_kmeans([doc["doc"] for doc in cluster],
+                                        [doc["embedding"] for doc in cluster],
+                                        n_clusters=n_subclusters)
+            subclusters = [subcluster for subcluster in subclusters.values()]
+            clusters.remove(cluster)
+            clusters.extend(subclusters)
+
+    return clusters
+
+def synthetic_facts(n, dimensions=768, seed=0):
+    # facts scattered around topics, roughly ten facts per topic
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(max(n // 10, 1), dimensions))
+    return topics[rng.integers(0, len(topics), n)] + 0.8 * rng.normal(size=(n, dimensions))
+
+if __name__ == "__main__":
+    args = ArgumentParser()
+    args.add_argument("sizes", nargs="*", type=int, default=[1000, 10000, 50000], help="Number of facts to cluster")
+    args.add_argument("--legacy-max", type=int, default=10000, help="Skip the sklearn baseline above this size, it needs O(n^2) memory")
+    args.add_argument("--max-size", type=int, default=10, help="Max. facts per cluster")
+    args = args.parse_args()
+
+    for n in args.sizes:
+        embeddings = synthetic_facts(n)
+        values = list(range(n))
+
+        if n <= args.legacy_max:
+            # the legacy code works on python lists of floats
+            as_lists = embeddings.tolist()
+            start = time()
+            legacy = legacy_agglomerative(values, as_lists, max_size=args.max_size)
+            legacy_took = time() - start
+            oversized = sum(1 for cluster in legacy if len(cluster) > args.max_size)
+            print(f"{n} facts, sklearn + kmeans split: {legacy_took:.2f}s, {len(legacy)} clusters, {oversized} above max size")
+        else:
+            print(f"{n} facts, sklearn + kmeans split: skipped")
+
+        start = time()
+        labels = cluster_labels(embeddings, max_size=args.max_size)
+        took = time() - start
+        sizes = np.bincount(labels)
+        print(f"{n} facts, llm.clustering:         {took:.2f}s, {len(sizes)} clusters, {int((sizes > args.max_size).sum())} above max size")
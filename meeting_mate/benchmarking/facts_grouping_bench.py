@@ -0,0 +1,130 @@
+from time import time
+from argparse import ArgumentParser
+from dotenv import dotenv_values
+from pymongo import ASCENDING, InsertOne, MongoClient
+import numpy as np
+
+# the work discovery and grouping queries _5_cluster_facts used before the clustered marker, kept as the baseline
+legacy_to_cluster_query = [
+    {'$group': {'_id': '$doc_id'}},
+    {'$lookup': {'from': 'facts', 'localField': '_id', 'foreignField': 'doc_id', 'as': 'result'}},
+    {'$match': {'result': []}}
+]
+
+def grouping_stages():
+    # same $group as _5_cluster_facts.group_facts_pipeline, without importing the module and its models
+    return [
+        {'$group': {'_id': {'doc_id': '$doc_id', 'user_id': '$user_id'},
+                    'facts': {'$push': '$facts'},
+                    'embeddings': {'$push': '$embeddings'},
+                    'organizations': {'$push': '$organizations'}}}
+    ]
+
+def legacy_group_pipeline():
+    return [{'$match': {'$expr': {'$eq': ['$doc_id', '$$doc_id']}}}] + grouping_stages()
+
+def group_pipeline(doc_id):
+    return [{'$match': {'doc_id': doc_id}}] + grouping_stages()
+
+def examined(explain) -> str:
+    # totals of every stage in an executionStats explain, independent of the hardware the benchmark runs on
+    totals = {"totalKeysExamined": 0, "totalDocsExamined": 0}
+    def walk(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key in totals and isinstance(value, int):
+                    totals[key] += value
+                else:
+                    walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+    walk(explain)
+    return f"{totals['totalKeysExamined']} keys, {totals['totalDocsExamined']} docs examined"
+
+def explain_aggregate(db, pipeline, **kwargs):
+    return db.command("explain", {"aggregate": "chunks", "pipeline": pipeline, "cursor": {}, **kwargs}, verbosity="executionStats")
+
+def populate(db, chunks, chunks_per_doc, facts_per_chunk, dimensions, dirty, batch_size=10000):
+    """
+    Synthetic chunks: `dirty` is the share of docs with unclustered chunks, every other doc already has facts.
+    """
+    rng = np.random.default_rng(0)
+    db["chunks"].drop()
+    db["facts"].drop()
+
+    docs = chunks // chunks_per_doc
+    dirty_docs = set(rng.choice(docs, int(docs * dirty), replace=False).tolist())
+
+    batch = []
+    for index in range(chunks):
+        doc = index // chunks_per_doc
+        batch.append(InsertOne({"doc_id": f"doc-{doc}",
+                                "user_id": f"user-{doc % 100}",
+                                "checksum": f"{index}",
+                                "facts": [f"fact {index}-{fact}" for fact in range(facts_per_chunk)],
+                                "embeddings": rng.normal(size=(facts_per_chunk, dimensions)).round(4).tolist(),
+                                "organizations": [f"org-{doc % 10}"],
+                                "clustered": doc not in dirty_docs}))
+        if len(batch) == batch_size:
+            db["chunks"].bulk_write(batch, ordered=False)
+            batch = []
+    if batch:
+        db["chunks"].bulk_write(batch, ordered=False)
+
+    db["facts"].insert_many([{"doc_id": f"doc-{doc}"} for doc in range(docs) if doc not in dirty_docs])
+
+    # the indexes _3_chunk_docs and _5_cluster_facts create
+    db["chunks"].create_index([("doc_id", ASCENDING), ("checksum", ASCENDING)], name="doc_id_checksum")
+    db["chunks"].create_index([("doc_id", ASCENDING)], name="unclustered_doc_id", partialFilterExpression={"clustered": False})
+    db["facts"].create_index([("doc_id", ASCENDING)], name="doc_id")
+
+if __name__ == "__main__":
+    """
+    Needs a MongoDB (mongo_uri from .env), writes to its own database which is dropped afterwards unless --keep is given.
+    """
+    args = ArgumentParser()
+    args.add_argument("--db", default="rag_facts_bench", help="Scratch database to use")
+    args.add_argument("-n", "--chunks", type=int, default=1_000_000, help="Number of synthetic chunks")
+    args.add_argument("--chunks-per-doc", type=int, default=10)
+    args.add_argument("--facts-per-chunk", type=int, default=5)
+    args.add_argument("--dimensions", type=int, default=64, help="Embedding size, kept small so 1M chunks fit on a laptop")
+    args.add_argument("--dirty", type=float, default=0.01, help="Share of docs waiting to be clustered")
+    args.add_argument("--samples", type=int, default=20, help="Docs to time the grouping pipeline on")
+    args.add_argument("--skip-populate", action="store_true", default=False, help="Reuse the data of a previous --keep run")
+    args.add_argument("--keep", action="store_true", default=False, help="Don't drop the scratch database")
+    args = args.parse_args()
+
+    client = MongoClient(dotenv_values().get("mongo_uri"))
+    db = client[args.db]
+
+    if not args.skip_populate:
+        start = time()
+        populate(db, args.chunks, args.chunks_per_doc, args.facts_per_chunk, args.dimensions, args.dirty)
+        print(f"Populated {args.chunks} chunks in {time() - start:.1f}s")
+
+    start = time()
+    legacy = [doc["_id"] for doc in db["chunks"].aggregate(legacy_to_cluster_query, allowDiskUse=True)]
+    print(f"Finding work, $group + $lookup:     {time() - start:.2f}s, {len(legacy)} docs, "
+          f"{examined(explain_aggregate(db, legacy_to_cluster_query, allowDiskUse=True))}")
+
+    start = time()
+    marked = db["chunks"].distinct("doc_id", {"clustered": False})
+    print(f"Finding work, clustered marker:     {time() - start:.2f}s, {len(marked)} docs, "
+          f"{examined(db.command('explain', {'distinct': 'chunks', 'key': 'doc_id', 'query': {'clustered': False}}, verbosity='executionStats'))}")
+
+    samples = marked[:args.samples]
+    start = time()
+    for doc_id in samples:
+        db["chunks"].aggregate(legacy_group_pipeline(), let={"doc_id": doc_id}).next()
+    print(f"Grouping facts, $expr match:        {(time() - start) / len(samples) * 1000:.1f}ms per doc, "
+          f"{examined(explain_aggregate(db, legacy_group_pipeline(), let={'doc_id': samples[0]}))} for one doc")
+
+    start = time()
+    for doc_id in samples:
+        db["chunks"].aggregate(group_pipeline(doc_id)).next()
+    print(f"Grouping facts, indexed match:      {(time() - start) / len(samples) * 1000:.1f}ms per doc, "
+          f"{examined(explain_aggregate(db, group_pipeline(samples[0])))} for one doc")
+
+    if not args.keep:
+        client.drop_database(args.db)
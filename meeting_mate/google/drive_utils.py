@@ -1,32 +1,109 @@
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
 from google.oauth2.credentials import Credentials
+from threading import Lock, local
+from collections import OrderedDict
+from concurrent.futures import Executor
+from time import monotonic, sleep
+import random
 import io
 
-def get_doc_contents(doc, *, credentials:Credentials) -> tuple[dict, bytes]:    
-    service = build('docs', 'v1', credentials=credentials)
-    driveService = build("drive", "v3", credentials=credentials)
+class RateLimiter:
+    """
+    Spaces out calls so that all threads sharing an instance stay below `qps` requests per second.
+    Google applies quotas per project, so a single instance should be shared by all users/workers.
+    """
+    def __init__(self, qps: float):
+        self._interval = 1.0 / qps
+        self._next = monotonic()
+        self._lock = Lock()
 
-    print("Fetching doc", doc.get("doc_id"))
-    jsonFormat = service.documents().get(documentId=doc["doc_id"]).execute()
-
-    # check/update permissions
-    permissions = driveService.permissions().list(fileId=doc["doc_id"]).execute()
-    sharedWith = []
-    for permission in permissions.get("permissions", []):
-        email = permission.get("emailAddress")
-        if email is not None:
-            sharedWith.append(email)
-
-    # add permissions if shared with people
-    
-    request = driveService.files().export_media(fileId=doc["doc_id"], mimeType="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+    def acquire(self):
+        with self._lock:
+            now = monotonic()
+            wait = self._next - now
+            self._next = max(self._next, now) + self._interval
+        if wait > 0:
+            sleep(wait)
+
+def _is_rate_limited(error: HttpError) -> bool:
+    if error.resp.status == 429:
+        return True
+    # drive reports most quota errors as 403 (userRateLimitExceeded, rateLimitExceeded)
+    return error.resp.status == 403 and "ratelimitexceeded" in error.content.decode("utf-8", "ignore").lower()
+
+def execute(request, limiter: RateLimiter = None, max_attempts=6):
+    """
+    Executes a google api request, honoring the rate limiter and backing off exponentially on 403/429 rate limit errors.
+    """
+    attempt = 1
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return request.execute()
+        except HttpError as e:
+            if not _is_rate_limited(e) or attempt >= max_attempts:
+                raise
+            backoff = min(2 ** attempt, 64) + random.random()
+            print(f"Rate limited by google api, retrying in {backoff:.1f}s (attempt {attempt})")
+            sleep(backoff)
+            attempt += 1
+
+# discovery clients are expensive to build and httplib2 isn't thread-safe, so every thread keeps its own
+_clients = local()
+
+def get_service(name: str, version: str, *, credentials: Credentials, max_cached=32):
+    cache = getattr(_clients, "cache", None)
+    if cache is None:
+        cache = _clients.cache = OrderedDict()
+
+    key = (name, version, credentials.token)
+    service = cache.get(key)
+    if service is None:
+        service = build(name, version, credentials=credentials, cache_discovery=False)
+        cache[key] = service
+        if len(cache) > max_cached:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(key)
+
+    return service
+
+def _get_document(doc_id, credentials, limiter):
+    service = get_service('docs', 'v1', credentials=credentials)
+    return execute(service.documents().get(documentId=doc_id), limiter)
+
+def _export_docx(doc_id, credentials, limiter):
+    driveService = get_service("drive", "v3", credentials=credentials)
+    request = driveService.files().export_media(fileId=doc_id, mimeType="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
     file = io.BytesIO()
-    
+
+    if limiter is not None:
+        limiter.acquire()
     downloader = MediaIoBaseDownload(file, request)
     done = False
     while done is False:
-        status, done = downloader.next_chunk()
+        status, done = downloader.next_chunk(num_retries=5)
+
+    return file.getvalue()
+
+def get_doc_contents(doc, *, credentials:Credentials, executor: Executor = None, limiter: RateLimiter = None, export=True) -> tuple[dict, bytes]:
+    """
+    Fetches the docs json and docx export of a document. With an executor, both requests run concurrently.
+    Pass export=False to skip the docx export (e.g. when it's cached locally), bytes will be None.
+    """
+    print("Fetching doc", doc.get("doc_id"))
+    doc_id = doc["doc_id"]
+
+    if executor is None:
+        jsonFormat = _get_document(doc_id, credentials, limiter)
+        bytes = _export_docx(doc_id, credentials, limiter) if export else None
+        return jsonFormat, bytes
+
+    exported = executor.submit(_export_docx, doc_id, credentials, limiter) if export else None
+    jsonFormat = _get_document(doc_id, credentials, limiter)
 
-    bytes = file.getvalue()
-    return jsonFormat, bytes
\ No newline at end of file
+    bytes = exported.result() if exported else None
+    return jsonFormat, bytes
@@ -3,7 +3,10 @@ from time import sleep
 from meeting_mate.mongo.mongo import INSTANCE as mongo
 from dotenv import dotenv_values
 from meeting_mate.google.google_auth import getUserCredentials
+from meeting_mate.google.drive_utils import RateLimiter, execute
 from googleapiclient.discovery import build
+from pymongo import ASCENDING, ReplaceOne
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from argparse import ArgumentParser
 
 env_values = dotenv_values()
@@ -14,75 +17,182 @@ mongo_db = env_values.get("mongo_db","rag")
 # connect to mongo
 db = mongo.db
 
-def check_doc(id, modifiedTime, user_id):
-    doc = db.docs.find_one({"doc_id": id})
-
-    if doc is None or doc.get("modifiedTime") != modifiedTime:
-        doc = {
-            "user_id": user_id,
-            "doc_id": id,
-            "modifiedTime": modifiedTime
-        }
-        print(f"New or modified doc found: {id}")
-        db.docs.replace_one({"doc_id": id}, doc, upsert=True)    
-
-def sync_user(user, last_sync):
+# check_docs looks up a whole page of doc_ids at once
+db.docs.create_index([("doc_id", ASCENDING)], name="doc_id")
+
+def check_docs(items, user_id) -> list[dict]:
+    # returns the new or modified docs
+    if not items:
+        return []
+
+    # one round trip to fetch the known modifiedTime for every doc on this page
+    known = {doc["doc_id"]: doc.get("modifiedTime") for doc in db.docs.find({"doc_id": {"$in": list(items.keys())}}, {"doc_id": 1, "modifiedTime": 1})}
+
+    updates = []
+    changed = []
+    for id, modifiedTime in items.items():
+        if known.get(id) != modifiedTime:
+            doc = {
+                "user_id": user_id,
+                "doc_id": id,
+                "modifiedTime": modifiedTime
+            }
+            print(f"New or modified doc found: {id}")
+            updates.append(ReplaceOne({"doc_id": id}, doc, upsert=True))
+            changed.append(doc)
+
+    if updates:
+        db.docs.bulk_write(updates, ordered=False)
+    return changed
+
+def drive_service(user):
     # check if access token is still valid
-    print(f"Syncing for user {user.get('sub')}")
     credentials = getUserCredentials(user.get("sub"))
-    service = build('drive', 'v3', credentials=credentials)
+    return build('drive', 'v3', credentials=credentials)
+
+def sync_user(user, last_sync, limiter: RateLimiter = None, service=None, on_changed=None):
+    print(f"Syncing for user {user.get('sub')}")
+    if service is None:
+        service = drive_service(user)
 
     # Call the Drive v3 API to list Google Docs
     page_token = None
     while True:
-        results = service.files().list(
+        results = execute(service.files().list(
             pageSize=100,
             includeItemsFromAllDrives=True,
             supportsAllDrives=True,
             fields="nextPageToken, files(id, name, mimeType, modifiedTime)",
             orderBy="modifiedTime desc",
             q="mimeType='application/vnd.google-apps.document'",
-            pageToken=page_token).execute()
-            
-    
-        for item in results.get('files', []):    
+            pageToken=page_token), limiter)
+
+        items = {}
+        reached_last_sync = False
+        for item in results.get('files', []):
             id = item.get("id")
             modifiedTime = datetime.strptime(item.get("modifiedTime"), "%Y-%m-%dT%H:%M:%S.%fZ")
-            
-            #break the loop when we start getting docs from before the last sync
+
+            #stop when we start getting docs from before the last sync
             if modifiedTime < (last_sync - timedelta(minutes=5)):
+                reached_last_sync = True
                 break
 
-            check_doc(id, modifiedTime, user.get("sub"))       
+            items[id] = modifiedTime
+
+        changed = check_docs(items, user.get("sub"))
+        if on_changed and changed:
+            on_changed(changed)
 
         page_token = results.get('nextPageToken')
-        if page_token is None:
+        if page_token is None or reached_last_sync:
             break
 
 
-def sync_all_users():
+def remove_docs(ids, user_id):
+    if not ids:
+        return
+
+    # only drop docs crawled for this user, others might still have access
+    query = {"doc_id": {"$in": list(ids)}, "user_id": user_id}
+    result = db.docs.delete_many(query)
+    db.chunks.delete_many(query)
+    db.facts.delete_many(query)
+    if result.deleted_count > 0:
+        print(f"Removed {result.deleted_count} deleted or unshared docs")
+
+def sync_user_changes(user, limiter: RateLimiter = None, on_changed=None):
+    """
+    Incremental sync via the drive changes API. The page token is kept on the user document,
+    so every cycle only pays for what changed since the last one. Users without a token get a full listing first.
+    on_changed is called with every page of new or modified docs.
+    """
+    user_id = user.get("sub")
+    service = drive_service(user)
+
+    page_token = user.get("drive_page_token")
+    if page_token is None:
+        # fetch the token before listing, so changes made during the full sync aren't lost
+        page_token = execute(service.changes().getStartPageToken(supportsAllDrives=True), limiter)["startPageToken"]
+        sync_user(user, datetime.fromtimestamp(0), limiter, service, on_changed)
+        db.users.update_one({"sub": user_id}, {"$set": {"drive_page_token": page_token}})
+        return
+
+    print(f"Syncing changes for user {user_id}")
+    while page_token is not None:
+        results = execute(service.changes().list(
+            pageToken=page_token,
+            pageSize=1000,
+            includeItemsFromAllDrives=True,
+            supportsAllDrives=True,
+            includeRemoved=True,
+            spaces="drive",
+            fields="nextPageToken, newStartPageToken, changes(changeType, removed, fileId, file(id, mimeType, modifiedTime, trashed))"), limiter)
+
+        items = {}
+        removed = set()
+        for change in results.get("changes", []):
+            if change.get("changeType") != "file":
+                continue
+
+            file = change.get("file") or {}
+            # removed is set for deletions and when the user lost access to the file
+            if change.get("removed") or file.get("trashed"):
+                removed.add(change.get("fileId"))
+            elif file.get("mimeType") == "application/vnd.google-apps.document":
+                items[file.get("id")] = datetime.strptime(file.get("modifiedTime"), "%Y-%m-%dT%H:%M:%S.%fZ")
+
+        changed = check_docs(items, user_id)
+        if on_changed and changed:
+            on_changed(changed)
+        remove_docs(removed, user_id)
+
+        # persist progress after every page, a crash resumes from here
+        next_token = results.get("nextPageToken")
+        db.users.update_one({"sub": user_id}, {"$set": {"drive_page_token": next_token or results.get("newStartPageToken")}})
+        page_token = next_token
+
+def sync_listed_user(user, last_sync, sync_start_time, limiter: RateLimiter = None, on_changed=None):
+    # users that haven't synced since the sync time moved onto the user fall back to the old global one
+    sync_user(user, user.get("last_sync", last_sync), limiter, None, on_changed)
+    # only moved forward once the user synced completely, a failed user lists the same docs again next time
+    db.users.update_one({"sub": user.get("sub")}, {"$set": {"last_sync": sync_start_time}})
+
+def sync_all_users(workers=1, qps=10, changes=False, on_changed=None):
     last_sync = db.config.find_one({"_id": "last_sync"})
     last_sync = datetime.fromtimestamp(0) if last_sync is None else last_sync.get("last_sync")
 
     sync_start_time = datetime.now(tz=timezone.utc)
 
-    for user in db.users.find():
-        sync_user(user, last_sync)
+    # drive quotas are per project, so all users share one limiter
+    limiter = RateLimiter(qps)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if changes:
+            futures = {executor.submit(sync_user_changes, user, limiter, on_changed): user.get("sub") for user in db.users.find()}
+        else:
+            futures = {executor.submit(sync_listed_user, user, last_sync, sync_start_time, limiter, on_changed): user.get("sub") for user in db.users.find()}
 
-    db.config.replace_one({"_id":"last_sync"}, {"_id": "last_sync", "last_sync": sync_start_time}, upsert=True)
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error syncing user {futures[future]}: {e}")
 
 if __name__ == "__main__":
     """
-    Simple sync loop. A more sensible solution would be to use the changes API
+    Simple sync loop. Pass --changes to use the changes API instead of listing recently modified files
     https://developers.google.com/drive/api/guides/manage-changes#python
     """
 
     args = ArgumentParser()
     args.add_argument("interval", nargs="?", type=int, default=60, help="Interval in seconds between syncs")
+    args.add_argument("-w", "--workers", type=int, default=1, help="Number of users to sync concurrently")
+    args.add_argument("-q", "--qps", type=float, default=10, help="Max. Drive API requests per second, shared by all workers")
+    args.add_argument("-c", "--changes", action="store_true", default=False, help="Sync incrementally using the drive changes API")
     args = args.parse_args()
 
     while True:
         print(f"{datetime.now()} Starting sync...")
-        sync_all_users()
+        sync_all_users(args.workers, args.qps, args.changes)
         print(f"{datetime.now()} Sync complete. Sleeping for {args.interval} seconds...")
         sleep(args.interval)
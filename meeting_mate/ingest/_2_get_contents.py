@@ -1,9 +1,14 @@
 import io
+import os
+from threading import get_ident
 from time import sleep
 from meeting_mate.mongo.mongo import INSTANCE as mongo
 import meeting_mate.google.drive_utils as drive_utils
 from dotenv import dotenv_values
 from meeting_mate.google.google_auth import getUserCredentials
+from meeting_mate.ingest.sections import converter
+from concurrent.futures import Executor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from argparse import ArgumentParser
 import mammoth
 
 env_values = dotenv_values()
@@ -11,27 +16,106 @@ env_values = dotenv_values()
 mongo_uri = env_values.get("mongo_uri")
 mongo_db = env_values.get("mongo_db","rag")
 
+# optional local cache of raw docx exports, allows re-converting without another drive export
+export_cache_dir = env_values.get("export_cache_dir")
+
 # connect to mongo
 db = mongo.db
 
-def retrieve_contents(doc):
+def _export_path(doc):
+    modifiedTime = doc.get("modifiedTime")
+    if not export_cache_dir or modifiedTime is None:
+        return None
+    return os.path.join(export_cache_dir, doc["doc_id"], f"{modifiedTime:%Y%m%dT%H%M%S%f}.docx")
+
+def load_export(doc):
+    path = _export_path(doc)
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return f.read()
+
+def store_export(doc, bytes):
+    path = _export_path(doc)
+    if path is None:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temp file first so concurrent readers never see a partial export
+    tmp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(bytes)
+    os.replace(tmp_path, path)
+
+def convert_docx(bytes) -> dict:
+    # parse the docx once, every other format is derived from the html
+    html = mammoth.convert_to_html(io.BytesIO(bytes)).value
+    markdown = converter.convert(html)
+    return {"html": html, "markdown": markdown}
+
+def retrieve_contents(doc, executor: Executor = None, limiter: drive_utils.RateLimiter = None):
     user_id = doc.get("user_id")
     credentials = getUserCredentials(user_id)
-    
-    jsonFormat, bytes = drive_utils.get_doc_contents(doc, credentials=credentials)
 
-    html = mammoth.convert_to_html(io.BytesIO(bytes)).value
-    markdown = mammoth.convert_to_markdown(io.BytesIO(bytes)).value
+    bytes = load_export(doc)
+    jsonFormat, exported = drive_utils.get_doc_contents(doc, credentials=credentials, executor=executor, limiter=limiter, export=bytes is None)
+    if bytes is None:
+        bytes = exported
+        store_export(doc, bytes)
 
-    updateDoc = {"content": jsonFormat, "html": html, "markdown": markdown, "title": jsonFormat.get("title")}
+    updateDoc = {"content": jsonFormat, **convert_docx(bytes), "title": jsonFormat.get("title")}
     result = db.docs.update_one({"doc_id": doc.get("doc_id")}, {"$set": updateDoc})
 
     # print warning if nothing was updated
     if result.matched_count == 0:
         print("Warning: no document was updated")
 
+    return {**doc, **updateDoc}
+
+def reconvert_contents(doc):
+    bytes = load_export(doc)
+    if bytes is None:
+        print(f"No cached export for doc {doc.get('doc_id')}, skipping")
+        return
+
+    # flag for re-chunking, chunks with unchanged checksums are kept
+    updateDoc = {**convert_docx(bytes), "chunked": False}
+    db.docs.update_one({"doc_id": doc.get("doc_id")}, {"$set": updateDoc})
+
 if __name__ == "__main__":
-    for doc in db.docs.find({"content": {"$exists": False}}):
-        print(f"Syncing doc {doc.get('_id')}")
-        retrieve_contents(doc)
+    args = ArgumentParser()
+    args.add_argument("-w", "--workers", type=int, default=8, help="Number of documents to fetch concurrently")
+    args.add_argument("-q", "--qps", type=float, default=10, help="Max. Google API requests per second")
+    args.add_argument("-r", "--reconvert", action="store_true", default=False, help="Re-convert all docs from cached exports (see export_cache_dir) - useful when you changed the conversion")
+    args = args.parse_args()
+
+    if args.reconvert:
+        for doc in db.docs.find({"content": {"$exists": True}}, {"doc_id": 1, "modifiedTime": 1}):
+            print(f"Re-converting doc {doc.get('_id')}")
+            reconvert_contents(doc)
+        exit(0)
+
+    limiter = drive_utils.RateLimiter(args.qps)
+
+    # each document runs its export on the fetch pool, next to the docs json request on the worker thread
+    with ThreadPoolExecutor(max_workers=args.workers) as fetch_pool, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for doc in db.docs.find({"content": {"$exists": False}}, {"doc_id": 1, "user_id": 1, "modifiedTime": 1}):
+            # keep at most twice the number of workers in flight
+            if len(futures) >= args.workers * 2:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    doc_id = futures.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"Error syncing doc {doc_id}: {e}")
+
+            print(f"Syncing doc {doc.get('_id')}")
+            futures[executor.submit(retrieve_contents, doc, fetch_pool, limiter)] = doc.get("doc_id")
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error syncing doc {futures[future]}: {e}")
 
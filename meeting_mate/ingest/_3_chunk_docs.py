@@ -1,10 +1,7 @@
-from datetime import datetime
 from dotenv import dotenv_values
-from bs4 import BeautifulSoup
-import re
-import markdownify
 from time import sleep
-from hashlib import md5
+from pymongo import ASCENDING
+from meeting_mate.ingest.sections import split_sections
 
 from meeting_mate.mongo.mongo import INSTANCE as mongo
 
@@ -16,110 +13,78 @@ mongo_db = env_values.get("mongo_db","rag")
 # connect to mongo
 db = mongo.db
 
-# corresponds to May 6, 2024
-date_format = "%b %d, %Y"
-
-# native regex to match the date
-date_regex = re.compile("[A-Z][a-z]{2} \\d{1,2}, \\d{4}")
-
-def generate_checksum(chunk):
-    bytes = chunk.encode("utf-8")
-    return md5(bytes).hexdigest()
-
-def getHeaderInfo(tag):
-    date_string = date_regex.search(tag.text)
-    date = datetime.strptime(date_string.group(), date_format) if date_string else None
-    calendar_link = next((a['href'] for a in tag.select('a') if a.has_attr('href') and "www.google.com/calendar/event" in a['href']), None)
-
-    if date and calendar_link:
-        return date, calendar_link
-    else:
-        return None
-
-def create_chunk(last_header, header, doc, date, calendar_link):
-    chunk = last_header.prettify()
-    sibling = None
-    while True:        
-        sibling = last_header.find_next_sibling()
-        if sibling and sibling!=header:
-            chunk += sibling.prettify()
-            sibling.extract()
-        else:
-            break
+def ensure_indexes():
+    # supports both the checksum diff and the stale chunk deletion in sync_chunks
+    db["chunks"].create_index([("doc_id", ASCENDING), ("checksum", ASCENDING)], name="doc_id_checksum")
 
-    chunk = "<html><body>"+chunk+"</body></html>"
-    
-    asMarkdown = markdownify.markdownify(chunk)
-    asMarkdown = re.sub(r'\n+', '\n', asMarkdown)
-    asMarkdown = f"Document title: {doc['title']} \n\n{asMarkdown}"
+ensure_indexes()
+
+def sync_chunks(doc, chunks, session=None):
+    """
+    Stores the chunks of a doc, keeping chunks whose checksum is unchanged.
+    Returns the newly inserted chunks and the number of deleted ones.
+    """
+    # fetch all known checksums for this doc in a single round trip
+    existing = set(chunk["checksum"] for chunk in db["chunks"].find({"doc_id": doc["doc_id"]}, {"_id": 0, "checksum": 1}, session=session))
+    all_checksums = set(chunk["checksum"] for chunk in chunks)
 
-    checksum = generate_checksum(asMarkdown)
-        
-    return {"doc_id": doc["doc_id"], 
-            "user_id":doc["user_id"], 
-            "html": chunk,
-            "checksum": checksum,
-            "markdown": asMarkdown,
-            "date": date, 
-            "calendar_link": calendar_link}
-
-def sync_chunks(chunks):
     # remove non-existing chunks first to account for modified/deleted ones
-    all_checksums = [chunk["checksum"] for chunk in chunks]
-    delete_query = {
-        "doc_id": chunks[0]["doc_id"],
-        "checksum": {"$nin": all_checksums}
-    }
-    result = db["chunks"].delete_many(delete_query)
-    deleted = result.deleted_count
+    deleted = 0
+    if existing - all_checksums:
+        delete_query = {
+            "doc_id": doc["doc_id"],
+            "checksum": {"$nin": list(all_checksums)}
+        }
+        result = db["chunks"].delete_many(delete_query, session=session)
+        deleted = result.deleted_count
+
+        if all_checksums:
+            # the facts of the deleted chunks are still in the doc's clusters
+            db["chunks"].update_many({"doc_id": doc["doc_id"]}, {"$set": {"clustered": False}}, session=session)
+        else:
+            # nothing left to cluster, drop the doc's facts right away
+            db["facts"].delete_many({"doc_id": doc["doc_id"]}, session=session)
 
+    # diff in memory, duplicate sections within a doc are only stored once
+    new_chunks = []
     unchanged = 0
-    inserted = 0
     for chunk in chunks:
-        # check if chunk already exists
-        count = db["chunks"].count_documents({"doc_id": chunk["doc_id"], "checksum": chunk["checksum"]})
-        if count > 0:
+        if chunk["checksum"] in existing:
             unchanged += 1
             continue
 
-        # insert new chunk    
-        db["chunks"].insert_one(chunk)
-        inserted += 1
+        existing.add(chunk["checksum"])
+        new_chunks.append(chunk)
 
-    db["docs"].update_one({"_id": doc["_id"]}, {"$set": {"chunked": True}})
+    inserted = 0
+    if new_chunks:
+        result = db["chunks"].insert_many(new_chunks, ordered=False, session=session)
+        inserted = len(result.inserted_ids)
+
+    db["docs"].update_one({"doc_id": doc["doc_id"]}, {"$set": {"chunked": True}}, session=session)
     print(f"Inserted {inserted} chunks, deleted {deleted} chunks, {unchanged} unchanged")
+    return new_chunks, deleted
 
 def chunk_doc(doc):
-    parsed = BeautifulSoup(doc["html"], "html.parser")
-    headers = parsed.findAll("h2")
-
     chunks = []
-    last_header = None
-
-    for header in headers:
-        header_info = getHeaderInfo(header)
-        if header_info: # is a header
-            date, calendar_link = header_info
-            if last_header:
-                chunks.append(create_chunk(last_header, header, doc, date, calendar_link))
-
-            last_header = header
-
-    if last_header:
-        chunks.append(create_chunk(last_header, None, doc, date, calendar_link))
+    for section in split_sections(doc["html"], doc["title"]):
+        chunks.append({"doc_id": doc["doc_id"],
+                       "user_id": doc["user_id"],
+                       **section})
 
-    #wrap in a transaction
-    try:
-        with db.client.start_session() as session:
-            with session.start_transaction():            
-                sync_chunks(chunks)
-    except Exception as e:
-        print(f"Error syncing chunks: {e}")
+    # wrap in a transaction, errors are raised so job queue workers can retry the doc
+    with db.client.start_session() as session:
+        with session.start_transaction():
+            return sync_chunks(doc, chunks, session)
 
 if __name__ == "__main__":
     print("Checking for docs to chunk...")
     for doc in db["docs"].find({"html":{"$exists": True}, "chunked": {"$ne": True}}):
-        chunk_doc(doc)
+        try:
+            chunk_doc(doc)
+        except Exception as e:
+            # the doc stays unchunked and is picked up by the next run
+            print(f"Error syncing chunks: {e}")
 
         
     
@@ -1,15 +1,20 @@
 import json
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient
 from dotenv import dotenv_values
-from meeting_mate.llm.prompts import Templates, facts_answer_schema
-from jsonschema import validate
+from meeting_mate.llm.prompts import Templates, facts_answer_schema, facts_batch_answer_schema
+from jsonschema import ValidationError, validate
 from meeting_mate.llm import models
+from meeting_mate.llm.cache import EmbeddingCache
+from meeting_mate.mongo.vectors import encode_many
+from meeting_mate.mongo.protocol import INSTANCE as protocol
+from datetime import datetime
 from langchain_core.messages import SystemMessage, HumanMessage
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from argparse import ArgumentParser
 
 llm = models.ChatModel(models.ChatModels.MIXTRAL_8x22B_INSTRUCT, temperature=0.7, max_tokens=8000)
-embeddings = models.EmbeddingsModel(models.EmbeddingModels.NOMIC_EMBED_TEXT_1_5)
+embedding_cache = EmbeddingCache(models.EmbeddingModels.NOMIC_EMBED_TEXT_1_5)
+embeddings = models.EmbeddingsModel(models.EmbeddingModels.NOMIC_EMBED_TEXT_1_5, cache=embedding_cache)
 
 values = dotenv_values()
 uri = values.get("mongo_uri")
@@ -19,6 +24,19 @@ client = MongoClient(uri)
 db = client[db]
 chunks_coll = db["chunks"]
 
+def _store_facts(doc, asJson):
+    facts_list = [fact for category in asJson["summary"].values() for fact in category]
+
+    update = {
+        "people": asJson.get("people", []),
+        "organizations": asJson.get("organizations", []),
+        "facts": facts_list
+    }
+
+    # update the document with the extracted facts
+    chunks_coll.update_one({"_id": doc["_id"]}, {"$set": update})
+    return facts_list
+
 def add_facts(doc):
     print(f"Extracting facts from {doc['_id']}")
     user = doc["user_id"]
@@ -32,54 +50,195 @@ def add_facts(doc):
     
     validate(asJson, facts_answer_schema)
 
-    facts_list = [fact for category in asJson["summary"].values() for fact in category]
-
-    update = {
-        "people": asJson["people"],
-        "organizations": asJson["organizations"],
-        "facts": facts_list
-    }
+    return _store_facts(doc, asJson)
 
-    # update the document with the extracted facts
-    chunks_coll.update_one({"_id": doc["_id"]}, {"$set": update})
-    return facts_list
+def add_facts_batch(docs) -> dict:
+    """
+    Extracts the facts of several chunks of the same user in one request, so the system prompt is sent once.
+    Chunks missing from the answer or failing validation fall back to add_facts. Returns the facts per chunk _id.
+    """
+    if len(docs) == 1:
+        return {docs[0]["_id"]: add_facts(docs[0])}
+
+    print(f"Extracting facts from {len(docs)} chunks: {', '.join(str(doc['_id']) for doc in docs)}")
+    user = docs[0]["user_id"]
+    # short ids, the model doesn't have to copy ObjectIds
+    ids = {f"c{index + 1}": doc for index, doc in enumerate(docs)}
+
+    system = SystemMessage(Templates.extract_facts_batch_system_prompt())
+    context = HumanMessage(Templates.extract_facts_batch_context_prompt({id: doc["markdown"] for id, doc in ids.items()}))
+
+    answers = None
+    try:
+        response, (prompt_tokens, _) = llm.invoke_with_usage([system, context], "fact_extraction", user, batch={"chunks": [doc["_id"] for doc in docs]})
+        answers = json.loads(response)
+    except Exception as e:
+        print(f"Batched extraction failed, extracting chunks one by one: {e}")
+
+    complete = False
+    if answers is not None:
+        try:
+            validate(answers, {**facts_batch_answer_schema, "required": list(ids.keys())})
+            complete = True
+        except ValidationError as e:
+            print(f"Batched extraction answer is incomplete, checking chunks one by one: {e.message}")
+    if not isinstance(answers, dict):
+        answers = {}
+
+    if complete:
+        # the single chunk prompts were never sent, their size is estimated and scaled by how the provider's count
+        # of the batch prompt compares to its estimate. Only recorded for batches that replaced all separate requests
+        calibration = prompt_tokens / models.estimate_tokens([system.content, context.content])
+        separate = sum(models.estimate_tokens([Templates.extract_facts_system_prompt(), Templates.extract_facts_context_prompt(doc["markdown"])]) for doc in docs)
+        saved = round(separate * calibration) - prompt_tokens
+        protocol.write({
+            "user": user,
+            "timestamp": datetime.now(),
+            "model": llm.model.value["id"],
+            "cost": 0,
+            "task": "fact_extraction_batch",
+            "batch": {"chunks": [doc["_id"] for doc in docs], "prompt_tokens": prompt_tokens, "tokens_saved": saved, "tokens_saved_per_chunk": saved / len(docs)}
+        })
+
+    facts = {}
+    for id, doc in ids.items():
+        try:
+            validate(answers.get(id), facts_answer_schema)
+        except Exception as e:
+            print(f"No valid facts for chunk {doc['_id']} in batch, extracting it alone: {e}")
+            facts[doc["_id"]] = add_facts(doc)
+            continue
+        facts[doc["_id"]] = _store_facts(doc, answers[id])
+    return facts
 
 def add_fact_embeddings(id, facts):
     doc = chunks_coll.find_one({"_id": id})
     user_id = doc["user_id"]
 
-    fact_embeddings = embeddings.invoke(facts, purpose="embed_facts", user=user_id)
+    # coalesced with the facts of other chunks being processed concurrently
+    fact_embeddings = embeddings.submit(facts, purpose="embed_facts", user=user_id).result()
     
-    chunks_coll.update_one({"_id": id}, {"$set": {"embeddings": fact_embeddings}})
+    # clustered: False flags the doc for _5_cluster_facts
+    chunks_coll.update_one({"_id": id}, {"$set": {"embeddings": encode_many(fact_embeddings), "clustered": False}})
 
 def add_facts_and_embeddings(doc):
     facts = add_facts(doc)
     add_fact_embeddings(doc["_id"], facts)
 
+def add_facts_and_embeddings_batch(docs):
+    facts = add_facts_batch(docs)
+    for doc in docs:
+        add_fact_embeddings(doc["_id"], facts[doc["_id"]])
+
+def pack_chunks(docs, token_budget=4000, max_chunks=8):
+    """
+    Groups consecutive chunks of the same doc into batches whose markdown fits token_budget.
+    Chunks over half the budget gain little from sharing a request and are sent alone.
+    """
+    batch = []
+    tokens = 0
+    for doc in docs:
+        size = models.estimate_tokens([doc["markdown"]])
+        alone = size > token_budget / 2
+        # batches are yielded in the order of their chunks, checkpoints rely on it
+        if batch and (alone or doc["doc_id"] != batch[0]["doc_id"] or tokens + size > token_budget or len(batch) >= max_chunks):
+            yield batch
+            batch = []
+            tokens = 0
+
+        if alone:
+            yield [doc]
+            continue
+
+        batch.append(doc)
+        tokens += size
+
+    if batch:
+        yield batch
+
+def iter_chunks(query, batch_size=100):
+    # page through chunks by _id, no long-lived cursor that could time out while workers are busy
+    last_id = None
+    while True:
+        page_query = query if last_id is None else {"$and": [query, {"_id": {"$gt": last_id}}]}
+        page = list(chunks_coll.find(page_query, {"_id": 1, "doc_id": 1, "user_id": 1, "markdown": 1}).sort("_id", ASCENDING).limit(batch_size))
+        if not page:
+            return
+        yield from page
+        last_id = page[-1]["_id"]
+
+def save_checkpoint(in_flight, last_submitted):
+    # everything below the oldest chunk still in flight is done
+    resume_from = min(in_flight.values()) if in_flight else None
+    if resume_from is None:
+        db["config"].update_one({"_id": "extract_facts"}, {"$set": {"resume_after": last_submitted}, "$unset": {"resume_from": ""}}, upsert=True)
+    else:
+        db["config"].update_one({"_id": "extract_facts"}, {"$set": {"resume_from": resume_from}, "$unset": {"resume_after": ""}}, upsert=True)
+
+def resume_query(query):
+    checkpoint = db["config"].find_one({"_id": "extract_facts"})
+    if checkpoint is None:
+        return query
+    if "resume_from" in checkpoint:
+        print(f"Resuming from chunk {checkpoint['resume_from']}")
+        return {"$and": [query, {"_id": {"$gte": checkpoint["resume_from"]}}]}
+    print(f"Resuming after chunk {checkpoint['resume_after']}")
+    return {"$and": [query, {"_id": {"$gt": checkpoint["resume_after"]}}]}
+
+def extract_all(query, workers, checkpoint=False, token_budget=None):
+    """
+    Streams matching chunks through the worker pool, keeping at most 2x workers requests in flight.
+    With checkpoint, progress is saved to the config collection as chunks complete.
+    With token_budget, small chunks of the same doc are extracted together (see pack_chunks).
+    """
+    in_flight = {}
+    last_submitted = None
+
+    def drain(return_when):
+        done, _ = wait(in_flight, return_when=return_when)
+        for future in done:
+            id = in_flight.pop(future)
+            try:
+                future.result()  # This will raise exceptions if any occurred during function execution
+            except Exception as e:
+                print(f"An error occurred on chunk {id}: {e}")
+        if checkpoint and done:
+            save_checkpoint(in_flight, last_submitted)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batches = pack_chunks(iter_chunks(query), token_budget) if token_budget else ([doc] for doc in iter_chunks(query))
+        for batch in batches:
+            if len(in_flight) >= workers * 2:
+                drain(FIRST_COMPLETED)
+
+            # chunks come sorted by _id, the first one of a batch is its lowest
+            in_flight[executor.submit(add_facts_and_embeddings_batch, batch)] = batch[0]["_id"]
+            last_submitted = batch[-1]["_id"]
+
+        while in_flight:
+            drain(FIRST_COMPLETED)
+
+    if checkpoint:
+        db["config"].delete_one({"_id": "extract_facts"})
+
 if __name__ == "__main__":
     """
     We probably want a queue-based system for this, so we can handle bursty behavior and handle provider limits/ have a deadletter queue
     """
     args = ArgumentParser(add_help=True)
-    args.add_argument("-w", "--workers", type=int, default=10, help="Number of workers to use for fact extraction (parallelism)")
+    args.add_argument("-w", "--workers", type=int, default=10, help="Number of workers to use for fact extraction (parallelism), provider calls are throttled further by the provider limiter")
     args.add_argument("-f", "--facts", action="store_true", default=False, help="Rerun fact extraction - useful when you changed prompts")
+    args.add_argument("-r", "--resume", action="store_true", default=False, help="Resume an interrupted --facts run from its last checkpoint")
+    args.add_argument("-b", "--batch", type=int, nargs="?", const=4000, default=None, metavar="TOKEN_BUDGET", help="Extract small chunks of the same doc together, up to this many tokens of content per request (default 4000)")
     args = args.parse_args()
 
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:  
-        if args.facts:
-            print("Re-extracting facts")
-            docs = chunks_coll.find()
-        else:    
-            docs = chunks_coll.find({"facts": {"$exists": False}})
-
-        futures = [executor.submit(add_facts_and_embeddings, doc) for doc in docs]
-
-        # To catch/print exceptions
-        for future in futures:
-            try:
-                future.result()  # This will raise exceptions if any occurred during function execution
-            except Exception as e:
-                print(f"An error occurred: {e}")
+    if args.facts:
+        print("Re-extracting facts")
+        query = resume_query({}) if args.resume else {}
+        extract_all(query, args.workers, checkpoint=True, token_budget=args.batch)
+    else:
+        # chunks without facts are picked up again anyway, no checkpoint needed
+        extract_all({"facts": {"$exists": False}}, args.workers, token_budget=args.batch)
 
+    print(f"Embedding cache: {embedding_cache.hits} hits, {embedding_cache.misses} misses")
     print("Done")
-    
\ No newline at end of file
@@ -1,67 +1,61 @@
 from meeting_mate.mongo.mongo import PLAIN_INSTANCE as mongo
-from collections import defaultdict
-from sklearn.preprocessing import normalize
-from sklearn.cluster import AgglomerativeClustering, KMeans
-from math import ceil
+from meeting_mate.llm.clustering import cluster_labels, group_by_label, normalize_rows
 from meeting_mate.llm.models import EmbeddingModels, EmbeddingsModel
+from meeting_mate.llm.cache import EmbeddingCache
+from meeting_mate.mongo.vectors import decode_many, decode_vector, encode_vector
 from argparse import ArgumentParser
+from pymongo import ASCENDING, DeleteOne, InsertOne, UpdateMany, UpdateOne
+import numpy as np
 
-group_facts_pipeline = [
-    {
-        '$match': {
-            '$expr': {
-                '$eq': [
-                    '$doc_id', '$$doc_id'
-                ]
-            }
-        }
-    }, {
-        '$group': {
-            '_id': {
-                'doc_id': '$doc_id', 
-                'user_id': '$user_id'
-            }, 
-            'facts': {
-                '$push': '$facts'
-            }, 
-            'embeddings': {
-                '$push': '$embeddings'
-            }, 
-            'organizations': {
-                '$push': '$organizations'
-            }, 
-            'people': {
-                '$push': '$people'
+def ensure_indexes():
+    # only chunks waiting for clustering are in this index, finding work doesn't scan the collection
+    mongo.db["chunks"].create_index([("doc_id", ASCENDING)], name="unclustered_doc_id", partialFilterExpression={"clustered": False})
+    mongo.db["facts"].create_index([("doc_id", ASCENDING)], name="doc_id")
+
+ensure_indexes()
+
+def group_facts_pipeline(doc_id: str):
+    # a plain equality match is served by the doc_id_checksum index, an $expr match against a variable is not
+    return [
+        {
+            '$match': {
+                'doc_id': doc_id
             }
-        }
-    }, {
-        '$project': {
-            'facts': {
-                '$reduce': {
-                    'input': '$facts', 
-                    'initialValue': [], 
-                    'in': {
-                        '$concatArrays': [
-                            '$$value', '$$this'
-                        ]
-                    }
+        }, {
+            '$group': {
+                '_id': {
+                    'doc_id': '$doc_id', 
+                    'user_id': '$user_id'
+                }, 
+                'facts': {
+                    '$push': '$facts'
+                }, 
+                'embeddings': {
+                    '$push': '$embeddings'
+                }, 
+                'organizations': {
+                    '$push': '$organizations'
+                }, 
+                'people': {
+                    '$push': '$people'
                 }
-            }, 
-            'embeddings': {
-                '$reduce': {
-                    'input': '$embeddings', 
-                    'initialValue': [], 
-                    'in': {
-                        '$concatArrays': [
-                            '$$value', '$$this'
-                        ]
+            }
+        }, {
+            '$project': {
+                'facts': {
+                    '$reduce': {
+                        'input': '$facts', 
+                        'initialValue': [], 
+                        'in': {
+                            '$concatArrays': [
+                                '$$value', '$$this'
+                            ]
+                        }
                     }
-                }
-            }, 
-            'organizations': {
-                '$setUnion': {
+                }, 
+                'embeddings': {
                     '$reduce': {
-                        'input': '$organizations', 
+                        'input': '$embeddings', 
                         'initialValue': [], 
                         'in': {
                             '$concatArrays': [
@@ -69,117 +63,189 @@ group_facts_pipeline = [
                             ]
                         }
                     }
+                }, 
+                'organizations': {
+                    '$setUnion': {
+                        '$reduce': {
+                            'input': '$organizations', 
+                            'initialValue': [], 
+                            'in': {
+                                '$concatArrays': [
+                                    '$$value', '$$this'
+                                ]
+                            }
+                        }
+                    }
                 }
             }
         }
+    ]
+
+def _facts_text(members):
+    return "\n".join([f"* {fact}" for fact in members])
+
+def _centroid(embeddings):
+    centroid = np.mean(normalize_rows(embeddings), axis=0)
+    return encode_vector(centroid / np.linalg.norm(centroid))
+
+def _cluster_doc(documentId, results, members, embeddings):
+    return {
+        "doc_id": documentId,
+        "user_id": results["_id"]["user_id"],
+        "organizations": results["organizations"],
+        "facts": _facts_text(members),
+        "members": members,
+        "centroid": _centroid(embeddings)
     }
-]
 
 def cluster_facts(documentId:str):
+    """
+    Clusters all facts of a document from scratch, replacing its existing clusters.
+    """
     print("Clustering facts for document", documentId)
-    results = mongo.db["chunks"].aggregate(group_facts_pipeline, let={"doc_id": documentId}).next()
+    results = mongo.db["chunks"].aggregate(group_facts_pipeline(documentId)).next()
     
-    clusters = agglomerative(results["facts"], results["embeddings"])
-    clusters = [[fact["doc"] for fact in cluster] for cluster in clusters]
+    clusters = agglomerative(results["facts"], decode_many(results["embeddings"]))
     
-    result_docs = []
+    result_docs = [_cluster_doc(documentId, results, [fact["doc"] for fact in cluster], [fact["embedding"] for fact in cluster]) for cluster in clusters]
+    embed_clusters(result_docs)
 
-    for cluster in clusters:
-        facts = "\n".join([f"* {fact}" for fact in cluster])
+    # only replaced once the new clusters are embedded, a failed embedding call leaves the old ones in place
+    mongo.db["facts"].delete_many({"doc_id": documentId})
+    if result_docs:
+        mongo.db["facts"].insert_many(result_docs)
 
-        doc = {
-            "doc_id": documentId,
-            "user_id": results["_id"]["user_id"],
-            "organizations": results["organizations"],
-            "facts": facts
-        }
+    return result_docs
 
-        result = mongo.db["facts"].insert_one(doc)
-        doc.update({"_id": result.inserted_id})
-        result_docs.append(doc)
+def recluster_facts(documentId:str, distance_threshold=0.5, max_size=10):
+    """
+    Incrementally updates the clusters of a document. Facts that are gone are dropped from their clusters,
+    new facts join the closest existing cluster if its centroid is within distance_threshold. Only leftover
+    facts and clusters that grew beyond max_size are clustered again.
+    Clusters whose text changed are embedded before anything is written, so a failed embedding call leaves
+    the doc's clusters as they were. Returns the cluster docs that were embedded.
+    """
+    print("Re-clustering facts for document", documentId)
+    existing = list(mongo.db["facts"].find({"doc_id": documentId}, {"embedding": 0}))
+    if not existing or any("members" not in cluster for cluster in existing):
+        # nothing to build on, e.g. clustered before clusters kept their members
+        return cluster_facts(documentId)
 
-    return result_docs
+    results = next(mongo.db["chunks"].aggregate(group_facts_pipeline(documentId)), None)
+    if results is None:
+        mongo.db["facts"].delete_many({"doc_id": documentId})
+        return []
 
-def kmeans(values, embeddings, n_clusters=2):
-    # normalize embeddings
-    norm_embeddings = normalize(embeddings)
+    embeddings = dict(zip(results["facts"], decode_many(results["embeddings"])))
+    # clusters written without an embedding by older versions get one now
+    unembedded = set(mongo.db["facts"].distinct("_id", {"doc_id": documentId, "embedding": {"$exists": False}}))
 
-    # cluster embeddings
-    clustering = KMeans(n_clusters=n_clusters, random_state=0, n_init='auto')
-    clustering.fit(norm_embeddings)
+    clusters = []
+    for cluster in existing:
+        members = [fact for fact in cluster["members"] if fact in embeddings]
+        clusters.append({"doc": cluster, "members": members, "touched": len(members) != len(cluster["members"]) or cluster["_id"] in unembedded})
 
-    clusters = defaultdict(list)
-    for index, (label, doc) in enumerate(zip(clustering.labels_, values)):
-        clusters[str(label)].append({"doc": doc, "embedding": embeddings[index]})
+    assigned = set(fact for cluster in clusters for fact in cluster["members"])
+    new_facts = [fact for fact in embeddings if fact not in assigned]
 
-    return clusters
+    # assign new facts to the closest existing cluster
+    leftovers = []
+    candidates = [cluster for cluster in clusters if cluster["members"]]
+    if candidates and new_facts:
+        centroids = np.array([decode_vector(cluster["doc"]["centroid"]) for cluster in candidates])
+        distances = 1 - normalize_rows([embeddings[fact] for fact in new_facts]) @ centroids.T
+        for fact, row in zip(new_facts, distances):
+            closest = int(np.argmin(row))
+            if row[closest] <= distance_threshold:
+                candidates[closest]["members"].append(fact)
+                candidates[closest]["touched"] = True
+            else:
+                leftovers.append(fact)
+    else:
+        leftovers = new_facts
 
-def agglomerative(values, embeddings, distance_threshold=0.5, max_size=10):
-    # normalize embeddings
-    norm_embeddings = normalize(embeddings)
+    # clusters that grew too large are split up again, together with the leftovers
+    for cluster in clusters:
+        if cluster["touched"] and len(cluster["members"]) > max_size:
+            leftovers.extend(cluster["members"])
+            cluster["members"] = []
 
-    # cluster embeddings
-    clustering = AgglomerativeClustering(metric='cosine', linkage='average', distance_threshold=distance_threshold, n_clusters=None)
-    clustering.fit(norm_embeddings)
+    to_embed = []
+    updates = []
+    deletes = []
+    for cluster in clusters:
+        doc = cluster["doc"]
+        if not cluster["members"]:
+            deletes.append(DeleteOne({"_id": doc["_id"]}))
+        elif cluster["touched"]:
+            update = _cluster_doc(documentId, results, cluster["members"], [embeddings[fact] for fact in cluster["members"]])
+            updates.append((doc["_id"], update))
+            if update["facts"] != doc["facts"] or doc["_id"] in unembedded:
+                to_embed.append(update)
 
-    clusters = defaultdict(list)
+    new_docs = []
+    if leftovers:
+        for cluster in agglomerative(leftovers, [embeddings[fact] for fact in leftovers], distance_threshold, max_size):
+            new_docs.append(_cluster_doc(documentId, results, [fact["doc"] for fact in cluster], [fact["embedding"] for fact in cluster]))
+    to_embed.extend(new_docs)
 
-    for index, (label, doc) in enumerate(zip(clustering.labels_, values)):        
-        clusters[str(label)].append({"doc": doc, "embedding": embeddings[index]})
+    # adds the embedding to the docs, written in the same operations as the cluster changes
+    embed_clusters(to_embed)
 
-    clusters = [cluster for cluster in clusters.values()]
+    writes = deletes + [UpdateOne({"_id": id}, {"$set": update}) for id, update in updates] + [InsertOne(doc) for doc in new_docs]
+    # organizations are shared by all clusters of a doc and aren't part of the embedded text
+    writes.append(UpdateMany({"doc_id": documentId}, {"$set": {"organizations": results["organizations"]}}))
 
-    # if a cluster is too large, split it
-    for cluster in clusters:
-        if len(cluster) > max_size:
-            # determine the number of subclusters
-            n_subclusters = ceil(len(cluster) / max_size)
-            subclusters = kmeans([doc["doc"] for doc in cluster], 
-                                        [doc["embedding"] for doc in cluster],
-                                        n_clusters=n_subclusters)
-            subclusters = [subcluster for subcluster in subclusters.values()]
-            clusters.remove(cluster)
-            clusters.extend(subclusters)
-            
-    # just the docs, no embeddings
-    return clusters
-
-model = EmbeddingsModel(EmbeddingModels.NOMIC_EMBED_TEXT_1_5)
-def add_embeddings(doc):
-    embeddings = model.invoke(doc["facts"], purpose="embed_facts", user=doc["user_id"])[0]
-    mongo.db["facts"].update_one({"_id": doc["_id"]}, {"$set": {"embedding": embeddings}})
-
-def cluster_and_embed(doc_id: str):
-    # remove old facts
-    mongo.db["facts"].delete_many({"doc_id": doc_id})
-    
-    # cluster facts
-    docs = cluster_facts(doc_id)
+    mongo.db["facts"].bulk_write(writes)
 
-    # re-embed facts
-    for doc in docs:
-        add_embeddings(doc)
+    print(f"{len(new_facts)} new facts, {len(leftovers)} re-clustered, {len(to_embed)} clusters embedded")
+    return to_embed
 
-    pass
+def agglomerative(values, embeddings, distance_threshold=0.5, max_size=10):
+    # average linkage with the size cap applied while merging, so no cluster has to be split afterwards
+    labels = cluster_labels(embeddings, distance_threshold, max_size)
+    return group_by_label([{"doc": doc, "embedding": embedding} for doc, embedding in zip(values, embeddings)], labels)
 
-to_cluster_query = [
-    {
-        '$group': {
-            '_id': '$doc_id'
-        }
-    }, {
-        '$lookup': {
-            'from': 'facts', 
-            'localField': '_id', 
-            'foreignField': 'doc_id', 
-            'as': 'result'
-        }
-    }, {
-        '$match': {
-            'result': []
-        }
-    }
-]
+embedding_cache = EmbeddingCache(EmbeddingModels.NOMIC_EMBED_TEXT_1_5)
+model = EmbeddingsModel(EmbeddingModels.NOMIC_EMBED_TEXT_1_5, cache=embedding_cache)
+def embed_clusters(docs):
+    # one provider call per batch of clusters, the embeddings are added to the docs before they are written
+    if docs:
+        embeddings = model.embed_many([doc["facts"] for doc in docs], purpose="embed_facts", user=docs[0]["user_id"])
+        for doc, embedding in zip(docs, embeddings):
+            doc["embedding"] = encode_vector(embedding)
+
+def claim_chunks(doc_id: str):
+    # cleared before the facts are read: chunks changing while we cluster are marked again by _4 and picked up next time
+    mongo.db["chunks"].update_many({"doc_id": doc_id, "clustered": {"$ne": True}}, {"$set": {"clustered": True}})
+
+def release_chunks(doc_id: str):
+    mongo.db["chunks"].update_many({"doc_id": doc_id}, {"$set": {"clustered": False}})
+
+def cluster_and_embed(doc_id: str, incremental=False):
+    claim_chunks(doc_id)
+    try:
+        if incremental:
+            # only touched clusters are updated, only changed cluster texts re-embedded
+            recluster_facts(doc_id)
+        else:
+            cluster_facts(doc_id)
+    except Exception:
+        # leave the doc for the next run
+        release_chunks(doc_id)
+        raise
+
+def backfill_markers():
+    """
+    Sets the clustered marker on chunks embedded before it existed. Docs that already have facts count as clustered.
+    Scans the chunks collection once, afterwards finding work is an index lookup.
+    """
+    clustered = mongo.db["facts"].distinct("doc_id")
+    done = mongo.db["chunks"].update_many({"clustered": {"$exists": False}, "doc_id": {"$in": clustered}}, {"$set": {"clustered": True}})
+    todo = mongo.db["chunks"].update_many({"clustered": {"$exists": False}, "embeddings": {"$exists": True}}, {"$set": {"clustered": False}})
+    print(f"Marked {done.modified_count} chunks as clustered, {todo.modified_count} as to be clustered")
+
+# facts of docs that lost all their chunks, _3 and the crawler clean these up as they go. Full scan, only run on demand
 to_delete_query = [
     {
         '$group': {
@@ -202,29 +268,33 @@ to_delete_query = [
 if __name__ == "__main__":
     args = ArgumentParser()
     args.add_argument("-f", "--force", action="store_true", required=False, default=False, help="Force recluster all facts")
+    args.add_argument("-i", "--incremental", action="store_true", required=False, default=False, help="Update existing clusters instead of rebuilding them (with --force)")
+    args.add_argument("-b", "--backfill", action="store_true", required=False, default=False, help="Set the clustered marker on chunks from before it existed, run once after upgrading")
+    args.add_argument("-c", "--cleanup", action="store_true", required=False, default=False, help="Delete facts of docs without chunks (scans the facts collection)")
 
     args = args.parse_args()
 
-    if args.force:
-        print("Forcing recluster of all facts")
-        mongo.db["facts"].delete_many({})
-        # basically everything
-        tocluster = mongo.db["chunks"].aggregate([{
-            '$group': {
-                '_id': '$doc_id'
-            }
-        }])
-    else:
-        # figure out which ones to delete
+    if args.backfill:
+        backfill_markers()
+
+    if args.cleanup:
         to_delete = list(mongo.db["facts"].aggregate(to_delete_query))
         print(f"Deleting {len(to_delete)} facts docs")
-        for fact in to_delete:
-            mongo.db["facts"].delete_many({"doc_id": fact["_id"]})
+        mongo.db["facts"].delete_many({"doc_id": {"$in": [fact["_id"] for fact in to_delete]}})
 
-        # figure out which ones to cluster
-        tocluster = mongo.db["chunks"].aggregate(to_cluster_query)
+    if args.force:
+        print("Forcing recluster of all facts")
+        if not args.incremental:
+            mongo.db["facts"].delete_many({})
+        # basically everything, distinct walks the doc_id index
+        tocluster = mongo.db["chunks"].distinct("doc_id")
+    else:
+        # docs with chunks whose facts changed since they were last clustered, served by the partial index
+        tocluster = mongo.db["chunks"].distinct("doc_id", {"clustered": False})
 
-    for doc in tocluster:
-        cluster_and_embed(doc["_id"])
+    print(f"{len(tocluster)} docs to cluster")
+    for doc_id in tocluster:
+        cluster_and_embed(doc_id, incremental=args.incremental)
 
-    print("Done clustering facts")
\ No newline at end of file
+    print(f"Embedding cache: {embedding_cache.hits} hits, {embedding_cache.misses} misses")
+    print("Done clustering facts")
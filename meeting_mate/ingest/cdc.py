@@ -4,7 +4,15 @@ import meeting_mate.ingest._3_chunk_docs as chunk_docs
 import meeting_mate.ingest._4_extract_facts as extract_facts
 import meeting_mate.ingest._5_cluster_facts as cluster_docs
 
-from threading import Timer, Lock
+from meeting_mate.ingest.jobs import INSTANCE as queue
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import OperationFailure
+from zlib import crc32
+from heapq import heappop, heappush
+from threading import Condition, Thread
+from time import monotonic, sleep
+from datetime import datetime
 
 def handle_doc_change(change):
     if change["operationType"] in ["replace", "insert"]:
@@ -16,27 +24,85 @@ def handle_doc_change(change):
             print("Contents updated, chunking...")
             chunk_docs.chunk_doc(change["fullDocument"])
 
-cluster_timers:dict[Timer] = {}
+class Debouncer:
+    """
+    Runs `fn(key)` once `delay` seconds passed without another schedule() for the same key.
+    A single thread keeps all due times in a heap, calls run on a bounded pool and never run
+    concurrently for the same key.
+    """
+    def __init__(self, fn, delay=30, workers=4):
+        self._fn = fn
+        self._delay = delay
+        self._due = {}
+        self._heap = []
+        self._running = set()
+        self._condition = Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self.coalesced = 0
+        self.executed = 0
 
-def cluster_doc(doc_id):
-    if cluster_timers.pop(doc_id, None) is None:
-        return # was already canceled
+        Thread(target=self._run, name="debouncer", daemon=True).start()
 
-    # delete existing facts
-    mongo.db["facts"].delete_many({"doc_id": doc_id})
+    @property
+    def pending(self):
+        return len(self._due)
 
-    # cluster and embed the new facts
-    cluster_docs.cluster_and_embed(doc_id)
+    @property
+    def busy(self):
+        with self._condition:
+            return len(self._due) + len(self._running)
 
-def defer_clustering(doc_id):   
-    timer = cluster_timers.pop(doc_id, None)
-    if timer is not None:
-        timer.cancel()
+    def schedule(self, key):
+        with self._condition:
+            if key in self._due:
+                self.coalesced += 1
+            self._push(key)
+            self._condition.notify()
 
-    timer = Timer(30, cluster_doc, [doc_id])
-    timer.start()
-    
-    cluster_timers[doc_id] = timer
+    def _push(self, key):
+        due = monotonic() + self._delay
+        self._due[key] = due
+        heappush(self._heap, (due, key))
+
+    def _run(self):
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                due, key = self._heap[0]
+                # superseded by a later schedule() of the same key
+                if self._due.get(key) != due:
+                    heappop(self._heap)
+                    continue
+
+                wait = due - monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+
+                heappop(self._heap)
+                if key in self._running:
+                    # still busy with this key, try again later
+                    self._push(key)
+                    continue
+
+                del self._due[key]
+                self._running.add(key)
+                self._executor.submit(self._execute, key)
+
+    def _execute(self, key):
+        try:
+            self._fn(key)
+        except Exception as e:
+            print(f"Error processing {key}: {e}")
+        finally:
+            with self._condition:
+                self._running.discard(key)
+                self.executed += 1
+
+clustering = Debouncer(lambda doc_id: cluster_docs.cluster_and_embed(doc_id, incremental=True), delay=30)
 
 def handle_chunk_change(change):
     if change["operationType"] == "insert":
@@ -44,8 +110,26 @@ def handle_chunk_change(change):
         extract_facts.add_facts_and_embeddings(change["fullDocument"])
     elif change["operationType"] == "update":
         if "embeddings" in change["updateDescription"]["updatedFields"]:
-            print("Embeddings added to chunk, deferring clustering")
-            defer_clustering(change["fullDocument"]["doc_id"])
+            clustering.schedule(change["fullDocument"]["doc_id"])
+            print(f"Embeddings added to chunk, deferring clustering ({clustering.pending} pending, {clustering.coalesced} coalesced, {clustering.executed} done)")
+
+def enqueue_doc_change(change):
+    if change["operationType"] in ["replace", "insert"]:
+        doc_id = change["fullDocument"]["doc_id"]
+        queue.enqueue("fetch", {"doc_id": doc_id}, key=f"fetch:{doc_id}")
+    elif change["operationType"] == "update":
+        if "content" in change["updateDescription"]["updatedFields"]:
+            doc_id = change["fullDocument"]["doc_id"]
+            queue.enqueue("chunk", {"doc_id": doc_id}, key=f"chunk:{doc_id}")
+
+def enqueue_chunk_change(change):
+    if change["operationType"] == "insert":
+        queue.enqueue("extract", {"chunk_id": change["fullDocument"]["_id"]})
+    elif change["operationType"] == "update":
+        if "embeddings" in change["updateDescription"]["updatedFields"]:
+            # re-enqueueing a waiting cluster job pushes it back, this debounces bursts of chunk updates
+            doc_id = change["fullDocument"]["doc_id"]
+            queue.enqueue("cluster", {"doc_id": doc_id}, key=f"cluster:{doc_id}", delay=30)
 
 cs_filter = [
     {
@@ -56,16 +140,106 @@ cs_filter = [
     }
 ]
 
-resume_token = None
-while True:
+def load_resume_token():
+    state = mongo.db["config"].find_one({"_id": "cdc_resume_token"})
+    return None if state is None else state.get("token")
+
+def save_resume_token(token):
+    mongo.db["config"].replace_one({"_id": "cdc_resume_token"}, {"_id": "cdc_resume_token", "token": token}, upsert=True)
+
+def partition_key(change):
+    # events of the same document always land on the same worker, keeping their order
+    doc = change.get("fullDocument") or {}
+    return doc.get("doc_id") or str(change["documentKey"]["_id"])
+
+def dispatch_change(change, on_doc_change, on_chunk_change):
+    if change["ns"]["coll"] == "docs":
+        on_doc_change(change)
+    elif change["ns"]["coll"] == "chunks":
+        on_chunk_change(change)
+
+def handle_change(change, on_doc_change, on_chunk_change):
     try:
-        change_stream = mongo.db.watch(cs_filter, full_document='updateLookup')
-        for change in change_stream:
-            resume_token = change['_id']
-            if change["ns"]["coll"] == "docs":
-                handle_doc_change(change)
-            elif change["ns"]["coll"] == "chunks":
-                handle_chunk_change(change)            
+        dispatch_change(change, on_doc_change, on_chunk_change)
     except Exception as e:
-        print(e)
-    
\ No newline at end of file
+        print(f"Error handling {change['operationType']} on {change['ns']['coll']} {change['documentKey']['_id']}: {e}")
+        # the resume token moves past this event, keep it for retry_failed_changes
+        mongo.db["cdc_failed"].insert_one({"change": change, "error": repr(e), "timestamp": datetime.now()})
+
+def retry_failed_changes(on_doc_change, on_chunk_change):
+    retried = 0
+    for failed in mongo.db["cdc_failed"].find().sort("timestamp", 1):
+        try:
+            dispatch_change(failed["change"], on_doc_change, on_chunk_change)
+        except Exception as e:
+            print(f"Retrying {failed['_id']} failed again: {e}")
+            mongo.db["cdc_failed"].update_one({"_id": failed["_id"]}, {"$set": {"error": repr(e), "timestamp": datetime.now()}})
+            continue
+        mongo.db["cdc_failed"].delete_one({"_id": failed["_id"]})
+        retried += 1
+    return retried
+
+def process_changes(on_doc_change, on_chunk_change, workers=8, batch_size=100, idle_save_interval=300):
+    """
+    Runs the change stream, dispatching events onto `workers` single-threaded partitions by doc_id hash.
+    Different documents are handled in parallel, events of one document in order. The resume token is persisted
+    once a batch is fully processed, so restarts neither miss nor replay more than one batch. Events whose
+    handler fails are kept in the cdc_failed collection.
+    """
+    partitions = [ThreadPoolExecutor(max_workers=1) for _ in range(workers)]
+
+    while True:
+        resume_token = load_resume_token()
+        last_save = monotonic()
+        try:
+            with mongo.db.watch(cs_filter, full_document='updateLookup', resume_after=resume_token, max_await_time_ms=1000) as change_stream:
+                while change_stream.alive:
+                    batch = []
+                    while len(batch) < batch_size:
+                        change = change_stream.try_next()
+                        if change is None:
+                            break
+                        batch.append(change)
+
+                    futures = [partitions[crc32(partition_key(change).encode("utf-8")) % workers].submit(handle_change, change, on_doc_change, on_chunk_change) for change in batch]
+                    for future in futures:
+                        future.result()
+
+                    # the post batch resume token also advances while idle, every save does. Idle streams only save
+                    # now and then, so the token doesn't fall out of the oplog on quiet deployments
+                    if not batch and monotonic() - last_save < idle_save_interval:
+                        continue
+                    if change_stream.resume_token is not None and change_stream.resume_token != resume_token:
+                        resume_token = change_stream.resume_token
+                        save_resume_token(resume_token)
+                        last_save = monotonic()
+        except OperationFailure as e:
+            if e.code == 286: # ChangeStreamHistoryLost
+                print("Resume token is no longer in the oplog, starting from now")
+                mongo.db["config"].delete_one({"_id": "cdc_resume_token"})
+            else:
+                print(e)
+        except Exception as e:
+            print(e)
+
+if __name__ == "__main__":
+    args = ArgumentParser()
+    args.add_argument("-q", "--queue", action="store_true", default=False, help="Enqueue jobs for worker.py instead of processing changes inline")
+    args.add_argument("-w", "--workers", type=int, default=8, help="Number of documents to process in parallel")
+    args.add_argument("-r", "--retry-failed", action="store_true", default=False, help="Retry the events kept in cdc_failed and exit")
+    args = args.parse_args()
+
+    if args.retry_failed:
+        if args.queue:
+            print(f"Retried {retry_failed_changes(enqueue_doc_change, enqueue_chunk_change)} failed events")
+        else:
+            print(f"Retried {retry_failed_changes(handle_doc_change, handle_chunk_change)} failed events")
+            # clustering of retried chunks is deferred, wait for it before exiting
+            while clustering.busy:
+                sleep(1)
+        exit(0)
+
+    if args.queue:
+        process_changes(enqueue_doc_change, enqueue_chunk_change, args.workers)
+    else:
+        process_changes(handle_doc_change, handle_chunk_change, args.workers)
@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+import random
+import traceback
+from uuid import uuid4
+from pymongo import ASCENDING, ReturnDocument
+from meeting_mate.mongo.mongo import PLAIN_INSTANCE as mongo
+
+class JobQueue:
+    """
+    Durable work queue on top of a Mongo collection.
+
+    Workers lease jobs with findOneAndUpdate. A leased job becomes visible again once its visibility timeout
+    passes, so jobs of crashed workers are picked up by others. Failed jobs are retried with exponential backoff
+    and moved to the dead letter collection after `max_attempts`.
+    """
+    def __init__(self, collection="jobs", dead_letter="jobs_dead_letter", visibility_timeout=600, max_attempts=5, backoff=10):
+        self._coll = mongo.db[collection]
+        self._dead_letter = mongo.db[dead_letter]
+        self._visibility_timeout = visibility_timeout
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+
+        self._coll.create_index([("task", ASCENDING), ("available_at", ASCENDING)], name="task_available_at")
+        self._coll.create_index([("key", ASCENDING)], name="key", partialFilterExpression={"key": {"$exists": True}})
+
+    def enqueue(self, task: str, payload: dict, *, key: str = None, delay: float = 0):
+        """
+        Adds a job. Jobs with a key are deduplicated: enqueueing a key that is already waiting only
+        moves its due time, which debounces bursts of changes to the same document.
+        """
+        now = datetime.now()
+        available_at = now + timedelta(seconds=delay)
+
+        if key is None:
+            self._coll.insert_one({"task": task, "payload": payload, "attempts": 0, "created_at": now, "available_at": available_at, "lease_id": None})
+            return
+
+        self._coll.update_one({"key": key, "lease_id": None},
+                              {"$set": {"available_at": available_at},
+                               "$setOnInsert": {"task": task, "payload": payload, "attempts": 0, "created_at": now}},
+                              upsert=True)
+
+    def lease(self, tasks: list[str] = None):
+        while True:
+            now = datetime.now()
+            query = {"available_at": {"$lte": now}}
+            if tasks:
+                query["task"] = {"$in": tasks}
+
+            job = self._coll.find_one_and_update(query,
+                                                 {"$set": {"available_at": now + timedelta(seconds=self._visibility_timeout), "lease_id": uuid4().hex},
+                                                  "$inc": {"attempts": 1}},
+                                                 sort=[("available_at", ASCENDING)],
+                                                 return_document=ReturnDocument.AFTER)
+            if job is None or job["attempts"] <= self._max_attempts:
+                return job
+
+            # every attempt ended in an expired lease, e.g. the job keeps killing its worker process and never reaches fail()
+            error_info = {"error": "lease expired", "timestamp": now}
+            self._move_to_dead_letter(job, error_info)
+
+    def _move_to_dead_letter(self, job: dict, error_info: dict):
+        result = self._coll.delete_one({"_id": job["_id"], "lease_id": job["lease_id"]})
+        if result.deleted_count == 1:
+            self._dead_letter.insert_one({**job, "last_error": error_info})
+        print(f"Job {job['_id']} ({job['task']}) moved to dead letter after {job['attempts']} attempts")
+
+    def complete(self, job: dict):
+        # the lease id makes sure we don't drop a job another worker re-leased after our lease expired
+        self._coll.delete_one({"_id": job["_id"], "lease_id": job["lease_id"]})
+
+    def fail(self, job: dict, error: Exception):
+        error_info = {"error": repr(error), "traceback": traceback.format_exc(), "timestamp": datetime.now()}
+
+        if job["attempts"] >= self._max_attempts:
+            self._move_to_dead_letter(job, error_info)
+            return
+
+        backoff = self._backoff * 2 ** (job["attempts"] - 1) * (1 + random.random())
+        self._coll.update_one({"_id": job["_id"], "lease_id": job["lease_id"]},
+                              {"$set": {"available_at": datetime.now() + timedelta(seconds=backoff), "lease_id": None, "last_error": error_info}})
+        print(f"Job {job['_id']} ({job['task']}) failed, retrying in {backoff:.0f}s: {error}")
+
+    def requeue_dead_letters(self, task: str = None):
+        query = {} if task is None else {"task": task}
+        count = 0
+        for job in self._dead_letter.find(query):
+            job.pop("last_error", None)
+            self._coll.insert_one({**job, "attempts": 0, "available_at": datetime.now(), "lease_id": None})
+            self._dead_letter.delete_one({"_id": job["_id"]})
+            count += 1
+        return count
+
+INSTANCE = JobQueue()
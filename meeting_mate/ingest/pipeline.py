@@ -0,0 +1,164 @@
+import asyncio
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import meeting_mate.google.drive_utils as drive_utils
+import meeting_mate.ingest._1_crawl_drive as crawl_drive
+import meeting_mate.ingest._2_get_contents as get_contents
+import meeting_mate.ingest._3_chunk_docs as chunk_docs
+import meeting_mate.ingest._4_extract_facts as extract_facts
+import meeting_mate.ingest._5_cluster_facts as cluster_facts
+
+class IngestionPipeline:
+    """
+    Runs the ingestion stages as one asyncio pipeline: crawl -> fetch -> chunk -> extract -> cluster.
+
+    Every stage hands its output straight to the next one through a bounded queue, so a changed doc flows through
+    without any stage polling Mongo, and a slow stage makes the ones before it wait instead of piling up work.
+    Items a stage failed on are left unfinished in Mongo, every run starts by sweeping those back into their queues.
+    The stages call the same functions as the _N_ scripts, in threads, as pymongo, the Google client and the
+    LLM clients block.
+    """
+    def __init__(self, fetch_workers=8, extract_workers=10, cluster_workers=2, crawl_workers=1, qps=10, changes=False, queue_size=100):
+        self.fetch_workers = fetch_workers
+        self.extract_workers = extract_workers
+        self.cluster_workers = cluster_workers
+        self.crawl_workers = crawl_workers
+        self.qps = qps
+        self.changes = changes
+        self.queue_size = queue_size
+
+        self.limiter = drive_utils.RateLimiter(qps)
+        # each fetched doc runs its export on this pool (see drive_utils.get_doc_contents)
+        self.fetch_pool = ThreadPoolExecutor(max_workers=fetch_workers)
+
+    async def run(self, interval: float = None):
+        loop = asyncio.get_running_loop()
+        # room for every stage worker, plus crawling
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.fetch_workers + self.extract_workers + self.cluster_workers + self.crawl_workers + 4))
+
+        self.fetch_queue = asyncio.Queue(self.queue_size)
+        self.chunk_queue = asyncio.Queue(self.queue_size)
+        self.extract_queue = asyncio.Queue(self.queue_size)
+        self.cluster_queue = asyncio.Queue(self.queue_size)
+        # chunk level LLM calls across all docs being extracted
+        self.extract_slots = asyncio.Semaphore(self.extract_workers)
+
+        workers = []
+        workers += [asyncio.create_task(self._worker(self.fetch_queue, self.fetch)) for _ in range(self.fetch_workers)]
+        workers += [asyncio.create_task(self._worker(self.chunk_queue, self.chunk)) for _ in range(max(self.fetch_workers // 2, 1))]
+        workers += [asyncio.create_task(self._worker(self.extract_queue, self.extract)) for _ in range(self.extract_workers)]
+        workers += [asyncio.create_task(self._worker(self.cluster_queue, self.cluster)) for _ in range(self.cluster_workers)]
+
+        try:
+            while True:
+                print(f"{datetime.now()} Starting ingestion run...")
+                await self.sweep()
+                await self.crawl(loop)
+
+                # drain stage by stage, every stage only feeds the ones after it
+                for queue in [self.fetch_queue, self.chunk_queue, self.extract_queue, self.cluster_queue]:
+                    await queue.join()
+
+                print(f"{datetime.now()} Ingestion run complete")
+                if interval is None:
+                    break
+                await asyncio.sleep(interval)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.fetch_pool.shutdown(wait=False)
+
+    async def _worker(self, queue: asyncio.Queue, handle):
+        while True:
+            item = await queue.get()
+            try:
+                await handle(item)
+            except Exception as e:
+                print(f"Error in {handle.__name__} stage: {e}")
+            finally:
+                queue.task_done()
+
+    async def sweep(self):
+        """
+        Queues the work left unfinished by failed stages or an earlier process: docs crawled but never fetched
+        (crawling already stored their new modifiedTime, they wouldn't be listed again), fetched but not chunked,
+        chunks without embeddings and chunks waiting for clustering.
+        """
+        def find_unfinished():
+            to_fetch = list(chunk_docs.db["docs"].find({"content": {"$exists": False}}, {"doc_id": 1, "user_id": 1, "modifiedTime": 1}))
+            to_chunk = list(chunk_docs.db["docs"].find({"html": {"$exists": True}, "chunked": {"$ne": True}}, {"doc_id": 1, "user_id": 1, "title": 1, "html": 1}))
+            to_extract = {}
+            for chunk in extract_facts.iter_chunks({"embeddings": {"$exists": False}}):
+                to_extract.setdefault(chunk["doc_id"], []).append(chunk)
+            # docs still being extracted are queued for clustering once that's done
+            to_cluster = [doc_id for doc_id in chunk_docs.db["chunks"].distinct("doc_id", {"clustered": False}) if doc_id not in to_extract]
+            return to_fetch, to_chunk, to_extract, to_cluster
+
+        to_fetch, to_chunk, to_extract, to_cluster = await asyncio.to_thread(find_unfinished)
+        if to_fetch or to_chunk or to_extract or to_cluster:
+            print(f"Resuming unfinished work: {len(to_fetch)} docs to fetch, {len(to_chunk)} to chunk, "
+                  f"{sum(len(chunks) for chunks in to_extract.values())} chunks to extract, {len(to_cluster)} docs to cluster")
+
+        for doc in to_fetch:
+            await self.fetch_queue.put(doc)
+        for doc in to_chunk:
+            await self.chunk_queue.put(doc)
+        for doc_id, chunks in to_extract.items():
+            await self.extract_queue.put((doc_id, chunks))
+        for doc_id in to_cluster:
+            await self.cluster_queue.put(doc_id)
+
+    async def crawl(self, loop):
+        def on_changed(docs):
+            # called on crawler threads, blocks them while the fetch queue is full
+            for doc in docs:
+                asyncio.run_coroutine_threadsafe(self.fetch_queue.put(doc), loop).result()
+
+        await asyncio.to_thread(crawl_drive.sync_all_users, self.crawl_workers, self.qps, self.changes, on_changed)
+
+    async def fetch(self, doc):
+        print(f"Fetching doc {doc['doc_id']}")
+        doc = await asyncio.to_thread(get_contents.retrieve_contents, doc, self.fetch_pool, self.limiter)
+        await self.chunk_queue.put(doc)
+
+    async def chunk(self, doc):
+        new_chunks, deleted = await asyncio.to_thread(chunk_docs.chunk_doc, doc)
+        if new_chunks or deleted:
+            await self.extract_queue.put((doc["doc_id"], new_chunks))
+
+    async def extract(self, item):
+        doc_id, new_chunks = item
+
+        async def extract_chunk(chunk):
+            async with self.extract_slots:
+                await asyncio.to_thread(extract_facts.add_facts_and_embeddings, chunk)
+
+        # the doc is clustered once, after all of its chunks are done
+        results = await asyncio.gather(*[extract_chunk(chunk) for chunk in new_chunks], return_exceptions=True)
+        for chunk, result in zip(new_chunks, results):
+            if isinstance(result, Exception):
+                print(f"An error occurred on chunk {chunk['_id']}: {result}")
+        await self.cluster_queue.put(doc_id)
+
+    async def cluster(self, doc_id):
+        await asyncio.to_thread(cluster_facts.cluster_and_embed, doc_id, True)
+
+if __name__ == "__main__":
+    """
+    Runs all ingestion stages in one process, as an alternative to running the _N_ scripts one after the other.
+    """
+    args = ArgumentParser()
+    args.add_argument("interval", nargs="?", type=int, default=None, help="Interval in seconds between runs, runs once if not given")
+    args.add_argument("-c", "--changes", action="store_true", default=False, help="Crawl incrementally using the drive changes API")
+    args.add_argument("-q", "--qps", type=float, default=10, help="Max. Drive API requests per second")
+    args.add_argument("--crawl-workers", type=int, default=1, help="Number of users to crawl concurrently")
+    args.add_argument("--fetch-workers", type=int, default=8, help="Number of docs to fetch concurrently")
+    args.add_argument("--extract-workers", type=int, default=10, help="Number of concurrent fact extraction calls")
+    args.add_argument("--cluster-workers", type=int, default=2, help="Number of docs to cluster concurrently")
+    args.add_argument("--queue-size", type=int, default=100, help="Max. items waiting between two stages")
+    args = args.parse_args()
+
+    pipeline = IngestionPipeline(fetch_workers=args.fetch_workers, extract_workers=args.extract_workers, cluster_workers=args.cluster_workers,
+                                 crawl_workers=args.crawl_workers, qps=args.qps, changes=args.changes, queue_size=args.queue_size)
+    asyncio.run(pipeline.run(args.interval))
@@ -0,0 +1,109 @@
+from datetime import datetime
+from hashlib import md5
+import re
+from bs4 import BeautifulSoup, Tag
+import markdownify
+
+# corresponds to May 6, 2024
+date_format = "%b %d, %Y"
+
+# native regex to match the date
+date_regex = re.compile("[A-Z][a-z]{2} \\d{1,2}, \\d{4}")
+
+def generate_checksum(chunk):
+    bytes = chunk.encode("utf-8")
+    return md5(bytes).hexdigest()
+
+def getHeaderInfo(tag):
+    date_string = date_regex.search(tag.text)
+    date = datetime.strptime(date_string.group(), date_format) if date_string else None
+    calendar_link = next((a['href'] for a in tag.select('a') if a.has_attr('href') and "www.google.com/calendar/event" in a['href']), None)
+
+    if date and calendar_link:
+        return date, calendar_link
+    else:
+        return None
+
+def _has_parent(el, names):
+    parent = el.parent
+    while parent is not None:
+        if parent.name in names:
+            return True
+        parent = parent.parent
+    return False
+
+class SectionConverter(markdownify.MarkdownConverter):
+    """
+    markdownify's converter with a cheaper process_text. The stock implementation runs two
+    find_parent searches per text node, which dominates the conversion of larger documents.
+    Output is the same as markdownify 0.12.1.
+    """
+    def process_text(self, el):
+        text = str(el) or ''
+
+        # normalize whitespace if we're not inside a preformatted element
+        if not _has_parent(el, ('pre',)):
+            text = markdownify.whitespace_re.sub(' ', text)
+
+        # escape special characters if we're not inside a preformatted or code element
+        if not _has_parent(el, ('pre', 'code', 'kbd', 'samp')):
+            text = self.escape(text)
+
+        # remove trailing whitespaces if the text node is the last node in li or followed by an embedded list
+        if (el.parent.name == 'li'
+                and (not el.next_sibling
+                     or el.next_sibling.name in ['ul', 'ol'])):
+            text = text.rstrip()
+
+        return text
+
+converter = SectionConverter()
+
+def to_markdown(html:str, title:str)->str:
+    asMarkdown = converter.convert(html)
+    asMarkdown = re.sub(r'\n+', '\n', asMarkdown)
+    return f"Document title: {title} \n\n{asMarkdown}"
+
+def split_sections(html:str, title:str)->list[dict]:
+    """
+    Splits a meeting notes document into one section per dated h2 header (see getHeaderInfo).
+
+    The document is parsed once and every element is serialised exactly once, walking the
+    siblings of each header up to the next dated header. The section html and markdown are
+    identical to what the previous prettify/extract loop produced, so checksums don't change.
+    """
+    parsed = BeautifulSoup(html, "html.parser")
+
+    headers = []
+    for header in parsed.find_all("h2"):
+        header_info = getHeaderInfo(header)
+        if header_info:
+            headers.append((header, header_info))
+
+    sections = []
+    for index, (header, _) in enumerate(headers):
+        next_header = headers[index + 1][0] if index + 1 < len(headers) else None
+
+        # the previous implementation tagged each section with the following header's date,
+        # keep it that way so stored chunks stay consistent
+        date, calendar_link = headers[index + 1][1] if next_header else headers[index][1]
+
+        chunk = header.prettify()
+        for sibling in header.next_siblings:
+            if sibling is next_header:
+                break
+            if isinstance(sibling, Tag):
+                chunk += sibling.prettify()
+
+        chunk = "<html><body>"+chunk+"</body></html>"
+        asMarkdown = to_markdown(chunk, title)
+
+        sections.append({
+            "html": chunk,
+            "markdown": asMarkdown,
+            "checksum": generate_checksum(asMarkdown),
+            "date": date,
+            "calendar_link": calendar_link
+        })
+
+    return sections
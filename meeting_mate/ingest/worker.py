@@ -0,0 +1,81 @@
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import get_context
+from time import sleep
+
+def _handlers():
+    # imported lazily, every worker process sets up its own clients and models
+    from meeting_mate.mongo.mongo import PLAIN_INSTANCE as mongo
+    import meeting_mate.ingest._2_get_contents as crawl_docs
+    import meeting_mate.ingest._3_chunk_docs as chunk_docs
+    import meeting_mate.ingest._4_extract_facts as extract_facts
+    import meeting_mate.ingest._5_cluster_facts as cluster_docs
+
+    def fetch(payload):
+        doc = mongo.db["docs"].find_one({"doc_id": payload["doc_id"]})
+        if doc is not None:
+            crawl_docs.retrieve_contents(doc)
+
+    def chunk(payload):
+        doc = mongo.db["docs"].find_one({"doc_id": payload["doc_id"]})
+        if doc is not None:
+            chunk_docs.chunk_doc(doc)
+
+    def extract(payload):
+        chunk = mongo.db["chunks"].find_one({"_id": payload["chunk_id"]})
+        if chunk is not None:
+            extract_facts.add_facts_and_embeddings(chunk)
+
+    def cluster(payload):
+        cluster_docs.cluster_and_embed(payload["doc_id"], incremental=True)
+
+    return {"fetch": fetch, "chunk": chunk, "extract": extract, "cluster": cluster}
+
+def work(tasks: list[str] = None, poll_interval=1.0):
+    from meeting_mate.ingest.jobs import INSTANCE as queue
+    handlers = _handlers()
+    tasks = tasks or list(handlers.keys())
+
+    while True:
+        job = queue.lease(tasks)
+        if job is None:
+            sleep(poll_interval)
+            continue
+
+        try:
+            handlers[job["task"]](job["payload"])
+            queue.complete(job)
+        except Exception as e:
+            queue.fail(job, e)
+
+def _run_process(tasks, threads):
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(work, tasks) for _ in range(threads)]
+        # work only returns on errors outside of jobs, e.g. failing imports
+        for future in futures:
+            future.result()
+
+if __name__ == "__main__":
+    """
+    Drains the ingestion job queue (see jobs.py), fed by cdc.py --queue.
+    A slow LLM call only blocks its own worker thread, everything else keeps flowing.
+    """
+    args = ArgumentParser()
+    args.add_argument("-p", "--processes", type=int, default=2, help="Number of worker processes")
+    args.add_argument("-t", "--threads", type=int, default=4, help="Number of worker threads per process")
+    args.add_argument("--tasks", nargs="*", choices=["fetch", "chunk", "extract", "cluster"], help="Only work on these tasks")
+    args.add_argument("--requeue", action="store_true", default=False, help="Move dead letter jobs back into the queue and exit")
+    args = args.parse_args()
+
+    if args.requeue:
+        from meeting_mate.ingest.jobs import INSTANCE as queue
+        print(f"Requeued {queue.requeue_dead_letters()} dead letter jobs")
+        exit(0)
+
+    # spawn, forked MongoClients aren't safe to use
+    context = get_context("spawn")
+    processes = [context.Process(target=_run_process, args=(args.tasks, args.threads)) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
@@ -0,0 +1,177 @@
+from datetime import datetime, timezone
+from hashlib import sha256
+import json
+from threading import Lock
+from typing import Optional, Sequence
+import numpy as np
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+from meeting_mate.mongo.mongo import PLAIN_INSTANCE as mongo
+from meeting_mate.mongo.protocol import INSTANCE as protocol
+from meeting_mate.mongo.retrieval import normalize_query
+from meeting_mate.mongo.vectors import decode_vector, encode_vector
+from meeting_mate.llm.models import ChatModels, EmbeddingModels
+from meeting_mate.llm.prompts import Templates
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache keyed by model id and sha256 of the text, so unchanged texts are never
+    sent to the provider twice. Least recently used entries are evicted once `max_entries` is exceeded.
+    """
+    def __init__(self, model: EmbeddingModels, *, max_entries=1_000_000, trim_every=1000, collection="embedding_cache"):
+        self._model_id = model.value["id"]
+        self._coll = mongo.db[collection]
+        self._max_entries = max_entries
+        self._trim_every = trim_every
+        self._inserted = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._coll.create_index([("last_used", ASCENDING)], name="last_used")
+
+    def _key(self, text: str) -> str:
+        return f"{self._model_id}:{sha256(text.encode('utf-8')).hexdigest()}"
+
+    def get_many(self, texts: Sequence[str]) -> list[Optional[list[float]]]:
+        keys = [self._key(text) for text in texts]
+        found = {doc["_id"]: doc["embedding"] for doc in self._coll.find({"_id": {"$in": list(set(keys))}}, {"embedding": 1})}
+        if found:
+            self._coll.update_many({"_id": {"$in": list(found.keys())}}, {"$set": {"last_used": datetime.now()}})
+
+        results = [found.get(key) for key in keys]
+        with self._lock:
+            hits = sum(1 for result in results if result is not None)
+            self.hits += hits
+            self.misses += len(results) - hits
+
+        return results
+
+    def put_many(self, texts: Sequence[str], embeddings: Sequence[Sequence[float]]):
+        now = datetime.now()
+        docs = {}
+        for text, embedding in zip(texts, embeddings):
+            key = self._key(text)
+            docs[key] = {"_id": key, "model": self._model_id, "embedding": list(embedding), "last_used": now}
+
+        if not docs:
+            return
+
+        try:
+            self._coll.insert_many(list(docs.values()), ordered=False)
+        except BulkWriteError as e:
+            # another worker cached the same text in the meantime
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+        with self._lock:
+            self._inserted += len(docs)
+            trim = self._inserted >= self._trim_every
+            if trim:
+                self._inserted = 0
+
+        if trim:
+            self.trim()
+
+    def trim(self):
+        excess = self._coll.estimated_document_count() - self._max_entries
+        if excess <= 0:
+            return
+
+        oldest = [doc["_id"] for doc in self._coll.find({}, {"_id": 1}).sort("last_used", ASCENDING).limit(excess)]
+        result = self._coll.delete_many({"_id": {"$in": oldest}})
+        print(f"Evicted {result.deleted_count} cached embeddings")
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+def _digest(text: str) -> str:
+    return sha256(text.encode("utf-8")).hexdigest()
+
+def facts_version(facts: Sequence[dict]) -> str:
+    # the retrieved fact ids and their current text, a re-clustered fact changes its text and with it the version
+    return _digest("\n".join(sorted(f"{fact['_id']}:{_digest(fact['facts'])}" for fact in facts)))
+
+class AnswerCache:
+    """
+    Persistent cache of Q&A answers built with Templates.build_qa_context. An answer is reused when the same user asks
+    the same normalized question about the same organizations and retrieval returned the same facts, for the same model
+    and system prompt. With `similarity_threshold`, a question whose embedding is at least that cosine-similar to a cached
+    question of the same scope counts as the same question. Entries expire after `ttl` seconds, answers mention dates.
+    """
+    def __init__(self, *, ttl=86400, similarity_threshold: float = None, max_candidates=100, collection="answer_cache"):
+        self._coll = mongo.db[collection]
+        self._similarity_threshold = similarity_threshold
+        self._max_candidates = max_candidates
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._coll.create_index([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=ttl)
+        # serves the newest-first candidate lookup of _most_similar
+        self._coll.create_index([("scope", ASCENDING), ("created_at", DESCENDING)], name="scope_created_at")
+
+    def _scope(self, model: ChatModels, user: str, orgs: list[str], facts: Sequence[dict]) -> str:
+        prompt = _digest(Templates.answer_question_system_prompt())
+        return _digest(json.dumps([model.value["id"], prompt, user, sorted(orgs), facts_version(facts)]))
+
+    def get(self, model: ChatModels, *, user: str, orgs: list[str], facts: Sequence[dict], question: str, purpose: str,
+            question_embedding: Sequence[float] = None) -> Optional[str]:
+        start = datetime.now()
+        scope = self._scope(model, user, orgs, facts)
+        normalized = normalize_query(question)
+
+        found = self._coll.find_one({"_id": _digest(f"{scope}:{normalized}")}, {"answer": 1})
+        if found is None and self._similarity_threshold is not None and question_embedding is not None:
+            found = self._most_similar(scope, question_embedding)
+
+        with self._lock:
+            if found is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        protocol.write({
+            "user": user,
+            "timestamp": datetime.now(),
+            "model": model.value["id"],
+            "chat": {
+                "input": question,
+                "response": found["answer"]
+            },
+            "took": (datetime.now() - start).total_seconds(),
+            "cost": 0,
+            "task": purpose,
+            "cached": True
+        })
+        return found["answer"]
+
+    def _most_similar(self, scope: str, question_embedding: Sequence[float]) -> Optional[dict]:
+        candidates = list(self._coll.find({"scope": scope, "question_embedding": {"$exists": True}},
+                                          {"answer": 1, "question_embedding": 1}).sort("created_at", DESCENDING).limit(self._max_candidates))
+        if not candidates:
+            return None
+
+        query = np.asarray(question_embedding, dtype=np.float32)
+        embeddings = np.array([decode_vector(candidate["question_embedding"]) for candidate in candidates], dtype=np.float32)
+        similarities = embeddings @ query / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query) + 1e-12)
+        best = int(np.argmax(similarities))
+        return candidates[best] if similarities[best] >= self._similarity_threshold else None
+
+    def put(self, model: ChatModels, *, user: str, orgs: list[str], facts: Sequence[dict], question: str, answer: str,
+            question_embedding: Sequence[float] = None):
+        scope = self._scope(model, user, orgs, facts)
+        normalized = normalize_query(question)
+
+        # TTL expiry compares against UTC, naive local times would be off by the host's offset
+        doc = {"scope": scope, "user": user, "question": normalized, "answer": answer, "created_at": datetime.now(tz=timezone.utc)}
+        if question_embedding is not None:
+            doc["question_embedding"] = encode_vector(question_embedding)
+        self._coll.replace_one({"_id": _digest(f"{scope}:{normalized}")}, doc, upsert=True)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
@@ -1,19 +1,13 @@
 from collections import defaultdict
-from sklearn.preprocessing import normalize
-from sklearn.cluster import AgglomerativeClustering
+from meeting_mate.llm.clustering import cluster_labels
 
 
 def cluster_embeddings(values, embeddings, distance_threshold=0.5):
-    # normalize embeddings
-    norm_embeddings = normalize(embeddings)
-
-    # cluster embeddings
-    clustering = AgglomerativeClustering(n_clusters=None, metric='cosine', linkage='average', distance_threshold=distance_threshold)
-    clustering.fit(norm_embeddings)
+    labels = cluster_labels(embeddings, distance_threshold)
 
     clusters = defaultdict(list)
 
-    for label, doc in zip(clustering.labels_, values):
+    for label, doc in zip(labels, values):
         clusters[str(label)].append(doc)
 
     return clusters
\ No newline at end of file
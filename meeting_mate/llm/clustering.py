@@ -0,0 +1,145 @@
+from collections import defaultdict
+import numpy as np
+
+def normalize_rows(embeddings) -> np.ndarray:
+    vectors = np.array(embeddings, dtype=np.float32, order="C")
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    vectors /= norms
+    return vectors
+
+def _nn_chain(vectors: np.ndarray, distance_threshold: float, max_size: int = None) -> np.ndarray:
+    """
+    Average linkage clustering on cosine distances using the nearest-neighbor chain algorithm.
+    Merges that would exceed max_size are never made, so no cluster has to be split afterwards.
+    """
+    n = len(vectors)
+    if n < 2:
+        return np.zeros(n, dtype=np.int64)
+
+    distances = vectors @ vectors.T
+    np.subtract(1, distances, out=distances)
+    np.fill_diagonal(distances, np.inf)
+    if max_size is not None and max_size < 2:
+        distances[:] = np.inf
+
+    sizes = np.ones(n, dtype=np.int64)
+    parent = np.arange(n)
+    active = np.ones(n, dtype=bool)
+    next_start = 0
+    chain = []
+
+    while True:
+        if not chain:
+            while next_start < n and not active[next_start]:
+                next_start += 1
+            if next_start == n:
+                break
+            chain.append(next_start)
+
+        current = chain[-1]
+        row = distances[current]
+        nearest = int(np.argmin(row))
+        distance = row[nearest]
+
+        # prefer the previous chain element on ties, otherwise the chain can cycle
+        if len(chain) > 1 and row[chain[-2]] <= distance:
+            nearest = chain[-2]
+            distance = row[nearest]
+
+        if not distance <= distance_threshold:
+            # nothing within reach, and average linkage never brings clusters closer: final
+            active[current] = False
+            distances[current, :] = np.inf
+            distances[:, current] = np.inf
+            chain.pop()
+            continue
+
+        if len(chain) == 1 or nearest != chain[-2]:
+            chain.append(nearest)
+            continue
+
+        # reciprocal nearest neighbors, merge them (Lance-Williams update for average linkage)
+        chain.pop()
+        chain.pop()
+        keep, drop = min(current, nearest), max(current, nearest)
+        size_keep, size_drop = sizes[keep], sizes[drop]
+        merged = (distances[keep] * size_keep + distances[drop] * size_drop) / (size_keep + size_drop)
+        sizes[keep] = size_keep + size_drop
+
+        merged[keep] = np.inf
+        merged[drop] = np.inf
+        if max_size is not None:
+            merged[sizes + sizes[keep] > max_size] = np.inf
+
+        distances[keep, :] = merged
+        distances[:, keep] = merged
+        distances[drop, :] = np.inf
+        distances[:, drop] = np.inf
+        active[drop] = False
+        parent[drop] = keep
+
+    # resolve every point to its final cluster root
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+
+    _, labels = np.unique(parent, return_inverse=True)
+    return labels
+
+def _partition(vectors: np.ndarray, indices: np.ndarray, block_size: int):
+    """
+    Recursively bisects the points with spherical 2-means until every block fits block_size,
+    so the pairwise distance matrix of a block stays small.
+    """
+    if len(indices) <= block_size:
+        yield indices
+        return
+
+    points = vectors[indices]
+    first = points[int(np.argmin(points @ points[0]))]
+    second = points[int(np.argmin(points @ first))]
+    for _ in range(5):
+        side = points @ first >= points @ second
+        if side.all() or not side.any():
+            break
+        first = points[side].mean(axis=0)
+        second = points[~side].mean(axis=0)
+
+    if side.all() or not side.any():
+        # degenerate split, fall back to the median of the projection
+        projection = points @ (first - second)
+        side = projection >= np.median(projection)
+        if side.all() or not side.any():
+            side = np.arange(len(indices)) < len(indices) // 2
+
+    yield from _partition(vectors, indices[side], block_size)
+    yield from _partition(vectors, indices[~side], block_size)
+
+def cluster_labels(embeddings, distance_threshold=0.5, max_size: int = None, block_size=4096) -> np.ndarray:
+    """
+    Returns a cluster label per embedding: average linkage on cosine distance, cut at distance_threshold,
+    with clusters capped at max_size. Inputs above block_size are first partitioned into blocks which are
+    clustered independently, keeping memory at O(block_size^2) instead of O(n^2).
+    """
+    if len(embeddings) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    vectors = normalize_rows(embeddings)
+    labels = np.zeros(len(vectors), dtype=np.int64)
+
+    offset = 0
+    for block in _partition(vectors, np.arange(len(vectors)), block_size):
+        block_labels = _nn_chain(vectors[block], distance_threshold, max_size)
+        labels[block] = block_labels + offset
+        offset += int(block_labels.max()) + 1 if len(block) else 0
+
+    return labels
+
+def group_by_label(values, labels) -> list[list]:
+    clusters = defaultdict(list)
+    for label, value in zip(labels, values):
+        clusters[int(label)].append(value)
+    return list(clusters.values())
@@ -1,6 +1,14 @@
+import asyncio
+import json
+import random
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Dict, List, Sequence, Union
-from meeting_mate.mongo.mongo import INSTANCE as mongo
+from queue import Empty, Queue
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
+from typing import Any, Dict, Iterator, List, Sequence, Union
+from meeting_mate.mongo.protocol import INSTANCE as protocol
 from langchain_fireworks import ChatFireworks
 from langchain_openai import ChatOpenAI
 from openai import OpenAI
@@ -68,18 +76,21 @@ class EmbeddingModels(Enum):
         'type': ModelType.EMBEDDING,
         'price' : {
              'input': 0.008
-        }
-    },
+        },
+        'batch_size': 256
+    }
     MXBAI_LARGE = {
         'id': "mixedbread-ai/mxbai-embed-large-v1",
         'provider': ModelProvider.FIREWORKS,
         'type': ModelType.EMBEDDING,
         'price' : {
              'input': 0.016
-        }
+        },
+        'batch_size': 256
     }
 
-def _calculate_costs(metadata, model: ChatModels)->float:
+def _usage(metadata) -> tuple[int, int]:
+    # (input, output) tokens, output is 0 for embeddings
     usage = None
     if "usage" in metadata:
         usage = metadata["usage"]
@@ -89,18 +100,160 @@ def _calculate_costs(metadata, model: ChatModels)->float:
         usage = metadata["token_count"]
     else:
         raise Exception("No usage found in response meta")
-    
+
     input = usage["prompt_tokens"] if "prompt_tokens" in usage else usage["input_tokens"]
+    output = usage.get("completion_tokens", usage.get("output_tokens", 0))
+    return input, output
+
+def _calculate_costs(metadata, model: ChatModels)->float:
+    input, output = _usage(metadata)
     input = model.value["price"]["input"] * input / 1000000
 
     if(model.value["type"] == ModelType.EMBEDDING):
         return input
     
-    output = usage["completion_tokens"] if "completion_tokens" in usage else usage["output_tokens"]
     output = model.value["price"]["completion"] * output / 1000000
 
     return input + output
 
+def _total_tokens(metadata) -> int:
+    try:
+        return sum(_usage(metadata))
+    except Exception:
+        return None
+
+def _is_rate_limited(e: Exception) -> bool:
+    # openai.RateLimitError, the fireworks client's RateLimitError and HTTP errors carrying the status
+    return getattr(e, "status_code", None) == 429 or "RateLimit" in type(e).__name__
+
+class ProviderLimiter:
+    """
+    Request and token buckets plus a concurrency limit for one provider, shared by all models and threads.
+
+    The limits are scaled by an AIMD factor: every successful call adds `increase` back (up to the configured limits),
+    a 429 halves it, and so does latency per token rising to twice the best seen, at most once per `cooldown` seconds.
+    Token usage is estimated up front and corrected once the provider reports it.
+    """
+    def __init__(self, name: str, requests_per_minute: float, tokens_per_minute: float, max_concurrency: int,
+                 min_scale=0.05, increase=0.02, cooldown=5.0):
+        self.name = name
+        self._requests_per_second = requests_per_minute / 60
+        self._tokens_per_second = tokens_per_minute / 60
+        self._max_concurrency = max_concurrency
+        self._min_scale = min_scale
+        self._increase = increase
+        self._cooldown = cooldown
+
+        # a few seconds worth of burst
+        self._request_capacity = max(self._requests_per_second * 5, 1)
+        self._token_capacity = max(self._tokens_per_second * 5, 1)
+        self._request_level = self._request_capacity
+        self._token_level = self._token_capacity
+        self._updated = monotonic()
+
+        self.scale = 1.0
+        self._in_flight = 0
+        self._latency = None
+        self._best_latency = None
+        self._last_decrease = 0
+        self._cond = Condition()
+
+    def _refill(self):
+        now = monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._request_level = min(self._request_capacity, self._request_level + elapsed * self._requests_per_second * self.scale)
+        self._token_level = min(self._token_capacity, self._token_level + elapsed * self._tokens_per_second * self.scale)
+
+    def acquire(self, tokens: int):
+        # a call bigger than the bucket waits for a full bucket
+        tokens = min(tokens, self._token_capacity)
+        with self._cond:
+            while True:
+                self._refill()
+                concurrency = max(1, int(self._max_concurrency * self.scale))
+                if self._in_flight < concurrency and self._request_level >= 1 and self._token_level >= tokens:
+                    self._request_level -= 1
+                    self._token_level -= tokens
+                    self._in_flight += 1
+                    return
+
+                timeout = 1.0
+                if self._in_flight < concurrency:
+                    # until the buckets have refilled enough
+                    missing_requests = max(1 - self._request_level, 0) / (self._requests_per_second * self.scale)
+                    missing_tokens = max(tokens - self._token_level, 0) / (self._tokens_per_second * self.scale)
+                    timeout = min(max(missing_requests, missing_tokens, 0.01), 1.0)
+                self._cond.wait(timeout)
+
+    def release(self, *, latency: float = None, tokens: int = None, estimated: int = None, throttled=False):
+        with self._cond:
+            self._in_flight -= 1
+            now = monotonic()
+
+            if tokens is not None and estimated is not None:
+                # settle the estimate, the bucket may go into debt
+                self._token_level -= min(tokens, self._token_capacity) - min(estimated, self._token_capacity)
+
+            if throttled:
+                self._decrease(now, force=True)
+            elif latency is not None:
+                per_token = latency / max(tokens or estimated or 1, 1)
+                self._latency = per_token if self._latency is None else 0.8 * self._latency + 0.2 * per_token
+                self._best_latency = self._latency if self._best_latency is None else min(self._best_latency, self._latency)
+                if self._latency > 2 * self._best_latency:
+                    self._decrease(now)
+                else:
+                    self.scale = min(1.0, self.scale + self._increase)
+
+            self._cond.notify_all()
+
+    def _decrease(self, now: float, force=False):
+        if not force and now - self._last_decrease < self._cooldown:
+            return
+        self._last_decrease = now
+        self.scale = max(self._min_scale, self.scale * 0.5)
+        print(f"{self.name}: {'rate limited' if force else 'latency up'}, scaling limits to {self.scale:.0%}")
+
+    def call(self, fn, *, tokens: int, usage=None, max_attempts=6):
+        """
+        Runs fn within the limits, retrying 429s with exponential backoff.
+        usage maps the result to the number of tokens actually used.
+        """
+        for attempt in range(max_attempts):
+            self.acquire(tokens)
+            start = monotonic()
+            try:
+                result = fn()
+            except Exception as e:
+                self.release(throttled=_is_rate_limited(e))
+                if not _is_rate_limited(e) or attempt == max_attempts - 1:
+                    raise
+                sleep(min(2 ** attempt, 60) * (1 + random.random()))
+                continue
+
+            self.release(latency=monotonic() - start, tokens=usage(result) if usage else None, estimated=tokens)
+            return result
+
+# requests, tokens per minute and concurrent calls, override with e.g. fireworks_requests_per_minute in .env
+_PROVIDER_LIMITS = {
+    ModelProvider.FIREWORKS: {"requests_per_minute": 600, "tokens_per_minute": 2_000_000, "max_concurrency": 32},
+    ModelProvider.OPENAI: {"requests_per_minute": 500, "tokens_per_minute": 200_000, "max_concurrency": 16},
+}
+_limiters = {}
+_limiters_lock = Lock()
+
+def provider_limiter(provider: ModelProvider) -> ProviderLimiter:
+    with _limiters_lock:
+        if provider not in _limiters:
+            limits = {key: float(config.get(f"{provider.value}_{key}", value)) for key, value in _PROVIDER_LIMITS[provider].items()}
+            _limiters[provider] = ProviderLimiter(provider.value, limits["requests_per_minute"], limits["tokens_per_minute"], int(limits["max_concurrency"]))
+        return _limiters[provider]
+
+def estimate_tokens(texts: Sequence[str]) -> int:
+    # roughly 4 characters per token for english text
+    return sum(len(text) for text in texts) // 4 + 1
+
 def _getChat(model: ChatModels, temperature:float, max_tokens:int):
     if model.value["provider"] == ModelProvider.FIREWORKS:
         fireworks_key = config.get("fireworks_api_key")
@@ -117,9 +270,72 @@ def _getChat(model: ChatModels, temperature:float, max_tokens:int):
         raise Exception("Invalid provider")
 
 
+class _EmbeddingBatcher:
+    """
+    Coalesces concurrent embedding requests into provider-sized batches. Requests arriving within
+    `max_wait` seconds are merged per (purpose, user), so costs in the protocol stay attributable.
+    """
+    def __init__(self, model: "EmbeddingsModel", max_wait=0.02, max_concurrent_batches=4):
+        self._model = model
+        self._max_wait = max_wait
+        self._queue = Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches)
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, texts: list[str], purpose: str, user: str) -> Future:
+        future = Future()
+        self._queue.put((texts, purpose, user, future))
+        return future
+
+    def _run(self):
+        batch_size = self._model.batch_size
+        while True:
+            pending = [self._queue.get()]
+            count = len(pending[0][0])
+            deadline = monotonic() + self._max_wait
+
+            while count < batch_size:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except Empty:
+                    break
+                pending.append(item)
+                count += len(item[0])
+
+            groups = defaultdict(list)
+            for item in pending:
+                groups[(item[1], item[2])].append(item)
+
+            for (purpose, user), items in groups.items():
+                self._executor.submit(self._flush, purpose, user, items)
+
+    def _flush(self, purpose: str, user: str, items: list):
+        texts = [text for item in items for text in item[0]]
+        try:
+            results = self._model.embed_many(texts, purpose=purpose, user=user, requests=len(items))
+        except Exception as e:
+            for item in items:
+                item[3].set_exception(e)
+            return
+
+        offset = 0
+        for item in items:
+            item[3].set_result(results[offset:offset + len(item[0])])
+            offset += len(item[0])
+
 class EmbeddingsModel():
-    def __init__(self, model: EmbeddingModels):
+    def __init__(self, model: EmbeddingModels, cache=None):
         self._model = model
+        # optional meeting_mate.llm.cache.EmbeddingCache, consulted before calling the provider
+        self._cache = cache
+        self.batch_size = model.value.get("batch_size", 256)
+        self._batcher = None
+        self._batcher_lock = Lock()
+        self._limiter = provider_limiter(model.value["provider"])
         
         if model.value["provider"] == ModelProvider.FIREWORKS:
             fireworks_key = os.environ.get("fireworks_api_key")
@@ -144,14 +360,33 @@ class EmbeddingsModel():
 
         return embeddings, metadata
     
-    def invoke(self, input: Union[str, Sequence[str]], *,  purpose: str, user: str) -> Sequence[Sequence[float]]:
+    def invoke(self, input: Union[str, Sequence[str]], *,  purpose: str, user: str, requests: int = None) -> Sequence[Sequence[float]]:
+        if self._cache is None:
+            return self._invoke(input, purpose=purpose, user=user, requests=requests)
+
+        texts = [input] if isinstance(input, str) else list(input)
+        results = self._cache.get_many(texts)
+
+        # only send texts we haven't seen before, each of them once
+        missing = list(dict.fromkeys(text for text, result in zip(texts, results) if result is None))
+        if missing:
+            embeddings = self._invoke(missing, purpose=purpose, user=user, requests=requests, cached=len(texts) - len(missing))
+            self._cache.put_many(missing, embeddings)
+
+            embedded = dict(zip(missing, embeddings))
+            results = [result if result is not None else embedded[text] for text, result in zip(texts, results)]
+
+        return results
+
+    def _invoke(self, input: Union[str, Sequence[str]], *,  purpose: str, user: str, requests: int = None, cached: int = None) -> Sequence[Sequence[float]]:
+        texts = [input] if isinstance(input, str) else list(input)
         start = datetime.now()
-        results, metadata = self._embed(input)
+        results, metadata = self._limiter.call(lambda: self._embed(input), tokens=estimate_tokens(texts), usage=lambda result: _total_tokens(result[1]))
         took = (datetime.now() - start).total_seconds()
 
         costs = _calculate_costs(metadata, self._model)
 
-        mongo.db["protocol"].insert_one({
+        record = {
             "user": user,
             "timestamp":datetime.now(),
             "model": self._model.value["id"],
@@ -159,9 +394,46 @@ class EmbeddingsModel():
             "took":took,
             "cost": costs,
             "task": purpose
-        })
+        }
+        # number of coalesced callers, for batched calls
+        if requests is not None:
+            record["requests"] = requests
+        # number of inputs served from the embedding cache
+        if cached is not None:
+            record["cached"] = cached
 
+        protocol.write(record)
+
+        return results
+
+    def embed_many(self, inputs: Sequence[str], *, purpose: str, user: str, requests: int = None) -> list[Sequence[float]]:
+        """
+        Embeds any number of texts using provider-sized batches, one call and one protocol record per batch.
+        """
+        results = []
+        for offset in range(0, len(inputs), self.batch_size):
+            results.extend(self.invoke(list(inputs[offset:offset + self.batch_size]), purpose=purpose, user=user, requests=requests))
         return results
+
+    def submit(self, input: Union[str, Sequence[str]], *, purpose: str, user: str) -> Future:
+        """
+        Queues texts for embedding. Concurrent submissions are coalesced into shared provider calls by a
+        background batcher, the future resolves to the embeddings of this request only.
+        """
+        texts = [input] if isinstance(input, str) else list(input)
+        if not texts:
+            future = Future()
+            future.set_result([])
+            return future
+
+        with self._batcher_lock:
+            if self._batcher is None:
+                self._batcher = _EmbeddingBatcher(self)
+
+        return self._batcher.submit(texts, purpose, user)
+
+    async def ainvoke(self, input: Union[str, Sequence[str]], *, purpose: str, user: str) -> Sequence[Sequence[float]]:
+        return await asyncio.wrap_future(self.submit(input, purpose=purpose, user=user))
     
 class LangchainEmbeddingsModel(BaseModel, Embeddings):
     model: EmbeddingsModel = Field(default=None, required=True)
@@ -181,6 +453,12 @@ class ChatModel:
     def __init__(self, model: ChatModels, temperature=0.7, max_tokens=2000):
         self._model = model
         self._chat = _getChat(model, temperature, max_tokens)
+        self._limiter = provider_limiter(model.value["provider"])
+        self._max_tokens = max_tokens
+
+    @property
+    def model(self) -> ChatModels:
+        return self._model
 
     def _toSerializable(self, input: LanguageModelInput):
         if isinstance(input, str):
@@ -195,25 +473,88 @@ class ChatModel:
         else:
             raise Exception("Invalid input")
     
-    def invoke(self, input: LanguageModelInput, purpose: str, user: str):
-        start = datetime.now()
-        chat_response = self._chat.invoke(input)            
-        took = (datetime.now() - start).total_seconds()
+    def _prompt_tokens(self, input: LanguageModelInput) -> int:
+        return estimate_tokens([json.dumps(self._toSerializable(input), default=str)])
 
-        costs = _calculate_costs(chat_response.response_metadata, self._model)
+    def _estimate_tokens(self, input: LanguageModelInput) -> int:
+        # the prompt plus a guess at the completion, corrected once the provider reports usage
+        return self._prompt_tokens(input) + min(self._max_tokens, 1000)
 
-        mongo.db["protocol"].insert_one({
+    def _record(self, input: LanguageModelInput, response: str, metadata: dict, took: float, costs: float, purpose: str, user: str, **extra):
+        protocol.write({
             "user": user,
             "timestamp":datetime.now(),
             "model": self._model.value["id"],
             "chat": {
                 "input": self._toSerializable(input),
-                "response":chat_response.content,
-                "metadata":chat_response.response_metadata
+                "response":response,
+                "metadata":metadata
             },
             "took":took,
             "cost": costs,
-            "task": purpose
+            "task": purpose,
+            **extra
         })
 
-        return chat_response.content
\ No newline at end of file
+    def invoke(self, input: LanguageModelInput, purpose: str, user: str, **extra):
+        # extra fields are added to the protocol record
+        return self.invoke_with_usage(input, purpose, user, **extra)[0]
+
+    def invoke_with_usage(self, input: LanguageModelInput, purpose: str, user: str, **extra) -> tuple[str, tuple[int, int]]:
+        # also returns the (prompt, completion) tokens the provider reported
+        start = datetime.now()
+        chat_response = self._limiter.call(lambda: self._chat.invoke(input), tokens=self._estimate_tokens(input),
+                                           usage=lambda response: _total_tokens(response.response_metadata))
+        took = (datetime.now() - start).total_seconds()
+
+        costs = _calculate_costs(chat_response.response_metadata, self._model)
+
+        self._record(input, chat_response.content, chat_response.response_metadata, took, costs, purpose, user, **extra)
+
+        return chat_response.content, _usage(chat_response.response_metadata)
+
+    def stream(self, input: LanguageModelInput, purpose: str, user: str) -> Iterator[str]:
+        """
+        Yields the response as it is generated. The protocol record is written once the stream is done,
+        with the full response, usage and the time to the first token. Also when the consumer stops early.
+        Providers that report no usage on streams get estimated token counts, flagged with usage_estimated.
+        """
+        kwargs = {}
+        if self._model.value["provider"] == ModelProvider.OPENAI:
+            # otherwise the API sends no usage when streaming
+            kwargs["stream_options"] = {"include_usage": True}
+
+        estimated = self._estimate_tokens(input)
+        self._limiter.acquire(estimated)
+        start = datetime.now()
+        first_token = None
+        response = None
+        completed = False
+        throttled = False
+        try:
+            for chunk in self._chat.stream(input, **kwargs):
+                response = chunk if response is None else response + chunk
+                if chunk.content:
+                    if first_token is None:
+                        first_token = (datetime.now() - start).total_seconds()
+                    yield chunk.content
+            completed = True
+        except Exception as e:
+            throttled = _is_rate_limited(e)
+            raise
+        finally:
+            took = (datetime.now() - start).total_seconds()
+            content = response.content if response is not None else ""
+            metadata = dict(response.response_metadata) if response is not None else {}
+            if response is not None and response.usage_metadata:
+                metadata["usage"] = dict(response.usage_metadata)
+
+            usage_estimated = _total_tokens(metadata) is None
+            if usage_estimated:
+                # langchain_fireworks drops the usage of the final stream chunk, count the tokens ourselves
+                metadata["usage"] = {"prompt_tokens": self._prompt_tokens(input), "completion_tokens": estimate_tokens([content]) if content else 0}
+
+            self._limiter.release(latency=took if completed else None, tokens=_total_tokens(metadata), estimated=estimated, throttled=throttled)
+            costs = _calculate_costs(metadata, self._model)
+
+            self._record(input, content, metadata, took, costs, purpose, user, time_to_first_token=first_token, completed=completed, usage_estimated=usage_estimated)
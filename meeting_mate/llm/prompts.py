@@ -105,11 +105,52 @@ Reply using the following Json schema:
 Follow the schema strictly and don't introduce additional properties.
 """
 
+# several chunks in one request, one answer per chunk keyed by the id given in the prompt
+facts_batch_answer_schema = {
+    "type": "object",
+    "additionalProperties": facts_answer_schema
+}
+
+# only shows the id-keyed wrapper, the full example of an answer is in the system prompt above
+batch_example = {
+    "c1": {
+        "people": ["John Doe"],
+        "organizations": ["Acme Inc."],
+        "summary": {"misc": ["John Doe (Acme Inc.) suggests evaluating MongoDB Atlas as a back-end system."]}
+    },
+    "c2": {
+        "people": ["Bruce Wayne"],
+        "organizations": ["Wayne Enterprises"],
+        "summary": {"misc": ["Wayne Enterprises is evaluating the meeting summary product of Acme Inc."]}
+    }
+}
+
+validate(batch_example, facts_batch_answer_schema)
+
+batch_system_prompt = f"""{system_prompt}
+USER may provide several meeting minutes at once, each starting with a line "Minutes id: <id>". Summarize each of them separately,
+never mixing information between them, and reply with a single JSON object with one property per id, each following the schema above:
+{json.dumps(batch_example)}
+"""
+
 class Templates:
     @staticmethod
     def extract_facts_system_prompt()->str: 
         return system_prompt
 
+    @staticmethod
+    def extract_facts_batch_system_prompt()->str:
+        return batch_system_prompt
+
+    @staticmethod
+    def extract_facts_batch_context_prompt(contexts: dict[str, str])->str:
+        minutes = "\n            -------------\n".join(f"Minutes id: {id}\n{context}" for id, context in contexts.items())
+        return f"""{minutes}
+            -------------
+            Extract facts from each of the meeting minutes above according to your instructions and follow the specified JSON schema, keyed by minutes id.
+            Try and extract a high number of facts, not leaving out ANY information. 
+            Reply with JSON object only with no preambles. Don't quote the JSON object!!!"""
+
     @staticmethod
     def extract_facts_context_prompt(context)->str:
         return f"""Meeting minutes:
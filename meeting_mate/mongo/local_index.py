@@ -0,0 +1,182 @@
+import hashlib
+import os
+from threading import Lock, Thread
+from time import monotonic
+import numpy as np
+from meeting_mate.llm.clustering import normalize_rows
+from meeting_mate.mongo.retrieval import VectorBackend
+from meeting_mate.mongo.vectors import decode_many
+
+class _UserIndex:
+    def __init__(self, ids: list, organizations: list, matrix: np.ndarray, graph=None):
+        self.ids = ids
+        self.id_set = set(ids)
+        self.matrix = matrix
+        self.graph = graph
+        self.built_at = monotonic()
+
+        rows = {}
+        for row, orgs in enumerate(organizations):
+            for org in orgs or []:
+                rows.setdefault(org, []).append(row)
+        self.org_rows = {org: np.array(org_rows, dtype=np.int64) for org, org_rows in rows.items()}
+
+    def candidates(self, orgs: list[str]) -> np.ndarray:
+        # the organizations: {$in: orgs} pre-filter
+        matches = [self.org_rows[org] for org in orgs if org in self.org_rows]
+        if not matches:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(matches))
+
+class LocalVectorBackend(VectorBackend):
+    """
+    In-process stand-in for Atlas $vectorSearch, for load tests and dev boxes without Atlas Search.
+
+    Each user's vectors are normalized into a float32 matrix, memory-mapped from `directory`, and searched with
+    brute-force dot products, which is exact, so numCandidates has no effect. With hnsw=True (needs hnswlib) an
+    HNSW graph is built as well and searched with ef=numCandidates instead.
+
+    Indexes are built on a user's first search. A change stream on the collection marks users whose docs changed,
+    their index is rebuilt on their next search. Without change streams (standalone servers) indexes are rebuilt
+    after refresh_interval seconds.
+    """
+    def __init__(self, coll, embedding_field="embedding", directory=".vector_index", hnsw=False, watch=True, refresh_interval: float = None):
+        self.coll = coll
+        self.embedding_field = embedding_field
+        self.directory = directory
+        self.hnsw = hnsw
+        self.refresh_interval = refresh_interval
+
+        self._indexes = {}
+        self._dirty = set()
+        self._build_locks = {}
+        self._lock = Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        if watch:
+            Thread(target=self._watch, name="local-vector-index-watch", daemon=True).start()
+
+    def search(self, queryVector: list[float], *, user: str, orgs: list[str], top_k: int, numCandidates: int):
+        description = [{"localVectorSearch": {"path": self.embedding_field, "limit": top_k, "numCandidates": numCandidates,
+                                              "filter": {"organizations": {"$in": orgs}, "user_id": user}, "hnsw": self.hnsw}}]
+
+        index = self._index(user)
+        rows = index.candidates(orgs)
+        if len(rows) == 0:
+            return [], description
+
+        query = normalize_rows([queryVector])[0]
+        k = min(top_k, len(rows))
+        if index.graph is not None:
+            hits = self._search_graph(index, rows, query, k, numCandidates)
+        else:
+            hits = self._search_matrix(index, rows, query, k)
+
+        # cosine similarity mapped to [0, 1], like Atlas' vectorSearchScore
+        scores = {index.ids[row]: (1 + similarity) / 2 for row, similarity in hits}
+        docs = {doc["_id"]: doc for doc in self.coll.find({"_id": {"$in": list(scores.keys())}}, {self.embedding_field: 0, "centroid": 0})}
+
+        results = []
+        for id, score in scores.items():
+            # deleted since the index was built
+            if id in docs:
+                results.append({**docs[id], "score": score})
+        return results, description
+
+    def _search_matrix(self, index: _UserIndex, rows: np.ndarray, query: np.ndarray, k: int):
+        similarities = index.matrix[rows] @ query
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [(int(rows[i]), float(similarities[i])) for i in top]
+
+    def _search_graph(self, index: _UserIndex, rows: np.ndarray, query: np.ndarray, k: int, numCandidates: int):
+        allowed = np.zeros(len(index.ids), dtype=bool)
+        allowed[rows] = True
+        with self._lock:
+            # ef is index-wide state in hnswlib
+            index.graph.set_ef(max(numCandidates, k))
+            try:
+                labels, distances = index.graph.knn_query(query, k=k, filter=lambda label: allowed[label])
+            except RuntimeError:
+                # the graph couldn't reach k allowed points, e.g. a very selective filter
+                return self._search_matrix(index, rows, query, k)
+        return [(int(label), 1 - float(distance)) for label, distance in zip(labels[0], distances[0])]
+
+    def _stale(self, user: str, index: _UserIndex) -> bool:
+        if index is None or user in self._dirty:
+            return True
+        return self.refresh_interval is not None and monotonic() - index.built_at > self.refresh_interval
+
+    def _index(self, user: str) -> _UserIndex:
+        with self._lock:
+            index = self._indexes.get(user)
+            if not self._stale(user, index):
+                return index
+            build_lock = self._build_locks.setdefault(user, Lock())
+
+        # one build per user at a time, searches of other users go on
+        with build_lock:
+            with self._lock:
+                # built by another thread while we waited
+                index = self._indexes.get(user)
+                if not self._stale(user, index):
+                    return index
+                # changes arriving during the build mark the user again
+                self._dirty.discard(user)
+
+            index = self._build(user)
+            with self._lock:
+                self._indexes[user] = index
+            return index
+
+    def _build(self, user: str) -> _UserIndex:
+        docs = list(self.coll.find({"user_id": user, self.embedding_field: {"$exists": True}},
+                                   {self.embedding_field: 1, "organizations": 1}))
+        ids = [doc["_id"] for doc in docs]
+        organizations = [doc.get("organizations") for doc in docs]
+        if not docs:
+            return _UserIndex(ids, organizations, np.zeros((0, 0), dtype=np.float32))
+
+        vectors = normalize_rows(decode_many([doc[self.embedding_field] for doc in docs]))
+
+        # written next to the live file and swapped in, searches holding the old mapping are unaffected
+        path = os.path.join(self.directory, hashlib.sha256(user.encode()).hexdigest()[:32] + ".npy")
+        tmp_path = path + ".tmp"
+        matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=vectors.shape)
+        matrix[:] = vectors
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, path)
+        matrix = np.load(path, mmap_mode="r")
+
+        graph = None
+        if self.hnsw:
+            import hnswlib
+            graph = hnswlib.Index(space="ip", dim=vectors.shape[1])
+            graph.init_index(max_elements=len(vectors), ef_construction=200, M=16)
+            graph.add_items(vectors, np.arange(len(vectors)))
+
+        print(f"Built local vector index for user {user}: {len(ids)} vectors")
+        return _UserIndex(ids, organizations, matrix, graph)
+
+    def _owner(self, id):
+        # deletes carry no document, look the id up in the loaded indexes
+        with self._lock:
+            for user, index in self._indexes.items():
+                if id in index.id_set:
+                    return user
+        return None
+
+    def _watch(self):
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+        try:
+            with self.coll.watch(pipeline, full_document="updateLookup") as stream:
+                for change in stream:
+                    user = (change.get("fullDocument") or {}).get("user_id") or self._owner(change["documentKey"]["_id"])
+                    if user is not None:
+                        with self._lock:
+                            self._dirty.add(user)
+        except Exception as e:
+            if self.refresh_interval is None:
+                self.refresh_interval = 60
+            print(f"Change stream on {self.coll.name} failed, rebuilding local vector indexes every {self.refresh_interval}s: {e}")
@@ -0,0 +1,90 @@
+from time import time
+from argparse import ArgumentParser
+from pymongo import ASCENDING, UpdateOne
+from meeting_mate.mongo.mongo import PLAIN_INSTANCE as mongo
+from meeting_mate.mongo.vectors import decode_many, decode_vector, encode_many, encode_vector
+
+# collection -> fields holding a single vector, fields holding a list of vectors
+FIELDS = {
+    "chunks": ([], ["embeddings"]),
+    "facts": (["embedding", "centroid"], []),
+}
+
+def convert(coll, storage: str, batch_size=500):
+    """
+    Rewrites every stored vector of the collection in the given storage format.
+    Updates are conditional on the old value, a vector rewritten by ingestion in the meantime is left alone.
+    """
+    single, multi = FIELDS[coll]
+    projection = {field: 1 for field in single + multi}
+    converted = 0
+    last_id = None
+
+    while True:
+        query = {} if last_id is None else {"_id": {"$gt": last_id}}
+        page = list(mongo.db[coll].find(query, projection).sort("_id", ASCENDING).limit(batch_size))
+        if not page:
+            break
+        last_id = page[-1]["_id"]
+
+        writes = []
+        for doc in page:
+            for field in single:
+                if field in doc:
+                    writes.append(UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: encode_vector(decode_vector(doc[field]), storage)}}))
+            for field in multi:
+                if field in doc:
+                    writes.append(UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: encode_many(decode_many(doc[field]), storage)}}))
+
+        if writes:
+            converted += mongo.db[coll].bulk_write(writes, ordered=False).modified_count
+        print(f"{coll}: {converted} vector fields converted", end="\r")
+
+    print(f"{coll}: {converted} vector fields converted")
+
+def measure(samples=50):
+    for coll in FIELDS:
+        stats = mongo.db.command("collStats", coll)
+        print(f"{coll}: {stats['count']} docs, {stats['size'] / 2**20:.1f} MB data, {stats['storageSize'] / 2**20:.1f} MB on disk, {stats.get('avgObjSize', 0) / 1024:.1f} KB per doc, "
+              f"{stats['totalIndexSize'] / 2**20:.1f} MB indexes")
+        # Atlas Search indexes live outside of collStats, their size is shown in the Atlas UI
+        for index, size in stats.get("indexSizes", {}).items():
+            print(f"  {index}: {size / 2**20:.1f} MB")
+
+    # imported here, the clustering module sets up its embedding model on import
+    from meeting_mate.ingest._5_cluster_facts import group_facts_pipeline
+    doc_ids = [doc["_id"] for doc in mongo.db["chunks"].aggregate([{"$sample": {"size": samples}}, {"$group": {"_id": "$doc_id"}}])]
+    if not doc_ids:
+        return
+
+    start = time()
+    for doc_id in doc_ids:
+        next(mongo.db["chunks"].aggregate(group_facts_pipeline(doc_id)), None)
+    print(f"group_facts_pipeline: {(time() - start) / len(doc_ids) * 1000:.1f}ms per doc over {len(doc_ids)} docs")
+
+if __name__ == "__main__":
+    """
+    Converts stored embeddings between storage formats (see vectors.py), measuring size and grouping time before and after.
+    Set embedding_storage in .env to the same format, otherwise newly written vectors keep the old one.
+    """
+    args = ArgumentParser()
+    args.add_argument("--to", choices=["array", "float32", "int8"], required=True, help="Target storage format")
+    args.add_argument("--collections", nargs="*", choices=list(FIELDS.keys()), default=list(FIELDS.keys()))
+    args.add_argument("--samples", type=int, default=50, help="Chunks to sample docs for the grouping timing from")
+    args = args.parse_args()
+
+    print("Before:")
+    measure(args.samples)
+
+    for coll in args.collections:
+        convert(coll, args.to)
+
+    # compact so the freed space shows up in storageSize, not available on shared Atlas tiers
+    for coll in args.collections:
+        try:
+            mongo.db.command("compact", coll)
+        except Exception as e:
+            print(f"Could not compact {coll}: {e}")
+
+    print("After:")
+    measure(args.samples)
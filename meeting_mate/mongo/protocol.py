@@ -0,0 +1,76 @@
+import atexit
+from queue import Empty, Queue
+from threading import Event, Thread
+from time import monotonic
+from meeting_mate.mongo.mongo import PLAIN_INSTANCE as mongo
+
+_STOP = object()
+
+class ProtocolWriter:
+    """
+    Buffers usage protocol records and writes them from a background thread with insert_many,
+    whenever `max_batch` records are queued or `flush_interval` seconds have passed.
+    Protocol records hold no encrypted fields, so the plain client is used.
+    """
+    def __init__(self, collection="protocol", max_batch=100, flush_interval=1.0):
+        self._coll = mongo.db[collection]
+        self._max_batch = max_batch
+        self._flush_interval = flush_interval
+        self._queue = Queue()
+        self._closed = False
+
+        self._thread = Thread(target=self._run, name="protocol-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, record: dict):
+        self._queue.put(record)
+
+    def flush(self, timeout=10):
+        # blocks until everything queued so far is written
+        done = Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self, timeout=10):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                item = None
+
+            if isinstance(item, dict):
+                batch.append(item)
+                if deadline is None:
+                    deadline = monotonic() + self._flush_interval
+                if len(batch) < self._max_batch:
+                    continue
+
+            self._insert(batch)
+            batch = []
+            deadline = None
+
+            if isinstance(item, Event):
+                item.set()
+            elif item is _STOP:
+                return
+
+    def _insert(self, batch: list):
+        if not batch:
+            return
+        try:
+            self._coll.insert_many(batch, ordered=False)
+        except Exception as e:
+            print(f"Failed to write {len(batch)} protocol records: {e}")
+
+INSTANCE = ProtocolWriter()
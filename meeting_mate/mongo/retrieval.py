@@ -1,6 +1,12 @@
-from typing import Any
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+from time import monotonic, perf_counter
+from typing import Any, Callable
 from meeting_mate.mongo.mongo import PLAIN_INSTANCE as mongo
 from meeting_mate.llm.models import EmbeddingsModel
+from meeting_mate.mongo.vectors import encode_vector
 import json
 from pydantic import BaseModel, Field
 
@@ -8,6 +14,146 @@ from dotenv import load_dotenv
 
 load_dotenv(override=True)
 
+class VectorBackend(ABC):
+    """
+    Answers vector searches for the Retriever. Results are the matching docs without their vectors,
+    each with a score in [0, 1] as Atlas reports it for cosine similarity, plus a description of the query.
+    """
+    @abstractmethod
+    def search(self, queryVector: list[float], *, user: str, orgs: list[str], top_k: int, numCandidates: int) -> tuple[list[dict], Any]:
+        ...
+
+class AtlasVectorBackend(VectorBackend):
+    def __init__(self, coll, index: str, embedding_field: str):
+        self.coll = coll
+        self.index = index
+        self.embedding_field = embedding_field
+
+    def pipeline(self, queryVector: list[float], *, user: str, orgs: list[str], top_k: int, numCandidates: int) -> list[dict]:
+        filter = {
+            "organizations": {
+                "$in": orgs
+            },
+            "user_id": user
+        }
+
+        pipeline = [
+            {
+                '$vectorSearch': {
+                    'index': self.index,
+                    'path': self.embedding_field,
+                    # in the same format as the stored vectors
+                    'queryVector': encode_vector(queryVector),
+                    'limit': top_k,
+                    'numCandidates': numCandidates,
+                    'filter' : filter
+                }
+            },
+            {
+                '$addFields': {
+                    'score': {
+                        '$meta': 'vectorSearchScore'
+                    }
+                }
+            },
+            {
+                '$project': {
+                    f"{self.embedding_field}": 0,
+                    "centroid": 0
+                }
+            }
+        ]
+        return pipeline
+
+    def search(self, queryVector: list[float], *, user: str, orgs: list[str], top_k: int, numCandidates: int):
+        pipeline = self.pipeline(queryVector, user=user, orgs=orgs, top_k=top_k, numCandidates=numCandidates)
+        results = list(self.coll.aggregate(pipeline))
+        return results, pipeline
+
+def normalize_query(query: str) -> str:
+    # case and spacing don't change what is asked, punctuation can: "C++", "C#" and "C" are different questions
+    return " ".join(query.lower().split())
+
+class SearchCache:
+    """
+    In-process TTL/LRU cache for query embeddings and search results, keyed by user, organizations and normalized query.
+
+    Query embeddings only depend on the text and are kept until they expire. Search results of a user are dropped
+    as soon as that user's docs change, which `watch` picks up from a change stream. Without change streams,
+    results are at most `ttl` seconds old.
+    """
+    def __init__(self, max_entries=1000, ttl=600):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._embeddings = OrderedDict()
+        self._results = OrderedDict()
+        self._generations = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embedding(self, user: str, query: str, compute: Callable[[], list[float]]) -> list[float]:
+        return self._get(self._embeddings, (user, normalize_query(query)), user, compute, invalidate=False)
+
+    def results(self, kind: str, user: str, orgs: list[str], query: str, params: tuple, compute: Callable[[], Any]):
+        key = (kind, user, tuple(sorted(orgs)), normalize_query(query), params)
+        return self._get(self._results, key, user, compute, invalidate=True)
+
+    def _get(self, store: OrderedDict, key, user: str, compute: Callable[[], Any], invalidate: bool):
+        now = monotonic()
+        with self._lock:
+            entry = store.get(key)
+            if entry is not None and entry["expires_at"] > now:
+                store.move_to_end(key)
+                self.hits += 1
+                return entry["value"]
+            self.misses += 1
+            generation = self._generations.get(user, 0)
+
+        value = compute()
+
+        with self._lock:
+            # not cached if the user's docs changed while we computed
+            if not invalidate or self._generations.get(user, 0) == generation:
+                store[key] = {"value": value, "user": user, "expires_at": now + self._ttl}
+                store.move_to_end(key)
+                while len(store) > self._max_entries:
+                    store.popitem(last=False)
+        return value
+
+    def invalidate(self, user: str):
+        with self._lock:
+            self._generations[user] = self._generations.get(user, 0) + 1
+            for key in [key for key, entry in self._results.items() if entry["user"] == user]:
+                del self._results[key]
+
+    def _users_with(self, id) -> set[str]:
+        # deletes carry no document, only cached results that contain the doc are affected
+        with self._lock:
+            return set(entry["user"] for entry in self._results.values()
+                       if any(result.get("_id") == id for result in entry["value"][0]))
+
+    def watch(self, coll):
+        Thread(target=self._watch, args=(coll,), name="search-cache-watch", daemon=True).start()
+        return self
+
+    def _watch(self, coll):
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+        try:
+            with coll.watch(pipeline, full_document="updateLookup") as stream:
+                for change in stream:
+                    user = (change.get("fullDocument") or {}).get("user_id")
+                    users = {user} if user is not None else self._users_with(change["documentKey"]["_id"])
+                    for user in users:
+                        self.invalidate(user)
+        except Exception as e:
+            print(f"Change stream on {coll.name} failed, cached search results expire after {self._ttl}s: {e}")
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
 class Retriever(BaseModel):
     embeddingModel: EmbeddingsModel = Field(..., description="The embedding model to use for the retriever")
     vector_index: str
@@ -16,12 +162,16 @@ class Retriever(BaseModel):
     coll: Any = Field(init=False, default="", description="The collection to retrieve from")
     text_field:str
     embedding_field: str
+    backend: Any = Field(default=None, description="The VectorBackend answering vector searches, Atlas $vectorSearch if not set")
+    cache: Any = Field(default=None, description="Optional SearchCache for query embeddings and vector search results")
 
     class Config:
         arbitrary_types_allowed = True
 
     def model_post_init(self, __context: Any):
         self.coll = mongo.get_db()[self.colname]
+        if self.backend is None:
+            self.backend = AtlasVectorBackend(self.coll, self.vector_index, self.embedding_field)
 
     def facet(self, user:str, field:str):
         pipeline = [
@@ -52,45 +202,26 @@ class Retriever(BaseModel):
 
     
 
-    def vector_search(self, query: str, *, purpose:str, user:str, top_k: int = 5, numCandidates: int = 100, orgs: list[str]):
-        queryVector, = self.embeddingModel.invoke(query, purpose=purpose, user=user)
+    def embed_query(self, query: str, *, purpose:str, user:str) -> list[float]:
+        def embed():
+            # coalesced with concurrent queries
+            queryVector, = self.embeddingModel.submit(query, purpose=purpose, user=user).result()
+            return queryVector
 
-        filter = {
-            "organizations": {
-                "$in": orgs
-            },
-            "user_id": user
-        }
+        if self.cache is None:
+            return embed()
+        return self.cache.embedding(user, query, embed)
 
-        pipeline = [
-            {
-                '$vectorSearch': {
-                    'index': self.vector_index,
-                    'path': self.embedding_field,
-                    'queryVector': queryVector,
-                    'limit': top_k,
-                    'numCandidates': numCandidates,
-                    'filter' : filter
-                }
-            },
-            {
-                '$addFields': {
-                    'score': {
-                        '$meta': 'vectorSearchScore'
-                    }
-                }
-            },
-            {
-                '$project': {
-                    f"{self.embedding_field}": 0,
-                }
-            }
-        ]
+    def vector_search(self, query: str, *, purpose:str, user:str, top_k: int = 5, numCandidates: int = 100, orgs: list[str]):
+        def search():
+            queryVector = self.embed_query(query, purpose=purpose, user=user)
+            return self.backend.search(queryVector, user=user, orgs=orgs, top_k=top_k, numCandidates=numCandidates)
 
-        results = list(self.coll.aggregate(pipeline))
-        return results, pipeline
+        if self.cache is None:
+            return search()
+        return self.cache.results("vector", user, orgs, query, (top_k, numCandidates), search)
     
-    def keyword_search(self, query: str, *, user:str, top_k: int = 10, orgs: list[str]):
+    def keyword_pipeline(self, query: str, *, user:str, top_k: int = 10, orgs: list[str]) -> list[dict]:
         filterStage = [
             {
                 'equals': {
@@ -118,6 +249,9 @@ class Retriever(BaseModel):
                     }
                 }, 
             },
+            {
+                "$limit": top_k
+            },
             {
                 '$addFields': {
                     'score': {
@@ -127,31 +261,137 @@ class Retriever(BaseModel):
             },
             {
                 "$project": {
-                    "embedding": 0
+                    "embedding": 0,
+                    "centroid": 0
                 }
             }
         ]
+        return pipeline
 
+    def keyword_search(self, query: str, *, user:str, top_k: int = 10, orgs: list[str]):
+        pipeline = self.keyword_pipeline(query, user=user, top_k=top_k, orgs=orgs)
         results = list(self.coll.aggregate(pipeline))
 
         return results, pipeline
     
-    def hybrid_search(self, query: str, *, purpose:str, user:str, top_k: int = 5, numCandidates: int = 100, orgs: list[str]):
-        keyword_results, kv_pipeline = self.keyword_search(query, user=user, top_k=numCandidates, orgs=orgs)
-        vector_results, vec_pipeline = self.vector_search(query, purpose=purpose, user=user, top_k=top_k, numCandidates=numCandidates, orgs=orgs)
+    def hybrid_search(self, query: str, *, purpose:str, user:str, top_k: int = 5, numCandidates: int = 100, orgs: list[str],
+                      fusion: str = "weighted", weights: tuple[float, float] = (0.7, 0.3), rrf_k: int = 60, server_side: bool = False):
+        """
+        Combines vector and keyword search. The keyword leg runs on a background thread while the query is embedded
+        and the vector leg runs, with server_side both legs run in a single $unionWith pipeline and are fused in Mongo.
 
-        # normalize keyword scores to the 0-1 range
-        max_score = max([result["score"] for result in keyword_results])
-        keyword_scores = {}
-        for result in keyword_results:
-            keyword_scores[result["_id"]] = result["score"] / max_score
+        fusion is "weighted" (weights for the vector score and the keyword score normalized to 0-1) or "rrf"
+        (reciprocal rank fusion, 1 / (rrf_k + rank) summed over the legs). Docs found by only one leg count 0 for the other.
+        Returns the top_k fused results, the (keyword, vector) pipelines and the latency of each leg in seconds.
+        """
+        if fusion not in ["weighted", "rrf"]:
+            raise ValueError(f"Unknown fusion {fusion}")
 
-        # apply keyword boost to vector results
-        for result in vector_results:
-            result["score"] = result["score"]*0.7 + keyword_scores.get(result["_id"], 0)*0.3
+        start = perf_counter()
+        latency = {}
+
+        if server_side:
+            if not isinstance(self.backend, AtlasVectorBackend):
+                raise ValueError("server side fusion needs the Atlas vector backend")
+
+            queryVector = self.embed_query(query, purpose=purpose, user=user)
+            latency["embedding"] = perf_counter() - start
+
+            kv_pipeline = self.keyword_pipeline(query, user=user, top_k=numCandidates, orgs=orgs)
+            vec_pipeline = self.backend.pipeline(queryVector, user=user, orgs=orgs, top_k=numCandidates, numCandidates=numCandidates)
+            pipeline = fusion_pipeline(self.colname, vec_pipeline, kv_pipeline, top_k=top_k, fusion=fusion, weights=weights, rrf_k=rrf_k)
+
+            leg_start = perf_counter()
+            results = list(self.coll.aggregate(pipeline))
+            latency["search"] = perf_counter() - leg_start
+            latency["total"] = perf_counter() - start
+            return results, (kv_pipeline, pipeline), latency
+
+        def timed_keyword_search():
+            leg_start = perf_counter()
+            results = self.keyword_search(query, user=user, top_k=numCandidates, orgs=orgs)
+            return results, perf_counter() - leg_start
+
+        keyword_future = _executor.submit(timed_keyword_search)
+
+        queryVector = self.embed_query(query, purpose=purpose, user=user)
+        latency["embedding"] = perf_counter() - start
+
+        leg_start = perf_counter()
+        vector_results, vec_pipeline = self.backend.search(queryVector, user=user, orgs=orgs, top_k=numCandidates, numCandidates=numCandidates)
+        latency["vector"] = perf_counter() - leg_start
+
+        (keyword_results, kv_pipeline), latency["keyword"] = keyword_future.result()
+
+        results = fuse(vector_results, keyword_results, top_k=top_k, fusion=fusion, weights=weights, rrf_k=rrf_k)
+        latency["total"] = perf_counter() - start
+        return results, (kv_pipeline, vec_pipeline), latency
+
+# keyword legs of concurrent hybrid searches
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hybrid-search")
+
+def fuse(vector_results: list[dict], keyword_results: list[dict], *, top_k: int, fusion="weighted", weights=(0.7, 0.3), rrf_k=60) -> list[dict]:
+    # the client side twin of fusion_pipeline, legs are expected in descending score order
+    vector_weight, keyword_weight = weights
+    max_keyword = max([result["score"] for result in keyword_results], default=0)
+
+    docs = {}
+    scores = {}
+    for leg, results in [("vector", vector_results), ("keyword", keyword_results)]:
+        for rank, result in enumerate(results, start=1):
+            docs.setdefault(result["_id"], result)
+            if fusion == "rrf":
+                score = 1 / (rrf_k + rank)
+            elif leg == "vector":
+                score = vector_weight * result["score"]
+            else:
+                score = keyword_weight * result["score"] / max_keyword if max_keyword else 0
+            scores[result["_id"]] = scores.get(result["_id"], 0) + score
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    return [{**docs[id], "score": score} for id, score in ranked]
+
+def fusion_pipeline(colname: str, vec_pipeline: list[dict], kv_pipeline: list[dict], *, top_k: int, fusion="weighted", weights=(0.7, 0.3), rrf_k=60) -> list[dict]:
+    """
+    Single pipeline hybrid search: the vector leg, the keyword leg via $unionWith, then a $group per doc fusing
+    the legs' scores or ranks. $vectorSearch has to be the first stage, so the vector leg leads.
+    """
+    vector_weight, keyword_weight = weights
+
+    def leg(name, normalize):
+        # rank of each result within its leg, keyword scores are unbounded and normalized by the leg's max
+        window = {f'{name}_rank': {'$documentNumber': {}}}
+        score = '$score'
+        if normalize:
+            window[f'{name}_max'] = {'$max': '$score', 'window': {'documents': ['unbounded', 'unbounded']}}
+            score = {'$cond': [{'$gt': [f'${name}_max', 0]}, {'$divide': ['$score', f'${name}_max']}, 0]}
+        return [
+            {'$setWindowFields': {'sortBy': {'score': -1}, 'output': window}},
+            {'$addFields': {f'{name}_score': score}}
+        ]
+
+    def contribution(name, weight):
+        if fusion == "rrf":
+            return {'$cond': [{'$ifNull': [f'${name}_rank', False]}, {'$divide': [1, {'$add': [rrf_k, f'${name}_rank']}]}, 0]}
+        return {'$multiply': [weight, {'$ifNull': [f'${name}_score', 0]}]}
+
+    return vec_pipeline + leg("vector", normalize=False) + [
+        {'$unionWith': {'coll': colname, 'pipeline': kv_pipeline + leg("keyword", normalize=True)}},
+        {'$group': {
+            '_id': '$_id',
+            'doc': {'$first': '$$ROOT'},
+            'vector_score': {'$max': '$vector_score'},
+            'vector_rank': {'$min': '$vector_rank'},
+            'keyword_score': {'$max': '$keyword_score'},
+            'keyword_rank': {'$min': '$keyword_rank'}
+        }},
+        {'$addFields': {'score': {'$add': [contribution("vector", vector_weight), contribution("keyword", keyword_weight)]}}},
+        {'$sort': {'score': -1}},
+        {'$limit': top_k},
+        {'$replaceRoot': {'newRoot': {'$mergeObjects': ['$doc', {'score': '$score'}]}}},
+        {'$project': {'vector_rank': 0, 'vector_score': 0, 'keyword_rank': 0, 'keyword_max': 0, 'keyword_score': 0}}
+    ]
 
-        return vector_results, (kv_pipeline, vec_pipeline)
-    
 if __name__ == "__main__":
     from meeting_mate.llm.models import EmbeddingModels
     model = EmbeddingsModel(EmbeddingModels.NOMIC_EMBED_TEXT_1_5)
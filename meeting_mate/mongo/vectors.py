@@ -0,0 +1,49 @@
+from dotenv import dotenv_values
+from bson.binary import Binary
+import numpy as np
+
+# BSON binary subtype 9, the vector format Atlas Vector Search indexes natively
+VECTOR_SUBTYPE = 9
+_FLOAT32 = 0x27
+_INT8 = 0x03
+
+# "array" (BSON doubles, the default), "float32" or "int8"
+STORAGE = dotenv_values().get("embedding_storage", "array")
+
+def encode_vector(vector, storage: str = None):
+    """
+    Packs an embedding for storage. float32 takes 4 bytes per dimension instead of ~9 for an array of doubles,
+    int8 takes 1 byte: the vector is normalized and scaled to [-127, 127], which keeps cosine similarity intact.
+    """
+    storage = storage or STORAGE
+    if storage == "array":
+        return [float(value) for value in vector]
+
+    values = np.asarray(vector, dtype=np.float32)
+    if storage == "float32":
+        return Binary(bytes([_FLOAT32, 0]) + values.astype("<f4").tobytes(), VECTOR_SUBTYPE)
+    if storage == "int8":
+        norm = np.linalg.norm(values)
+        scaled = values / norm * 127 if norm else values
+        return Binary(bytes([_INT8, 0]) + np.round(scaled).astype(np.int8).tobytes(), VECTOR_SUBTYPE)
+    raise ValueError(f"Unknown embedding storage {storage}")
+
+def decode_vector(value) -> list[float]:
+    # accepts every storage format, collections can hold a mix while being migrated
+    if not isinstance(value, Binary):
+        return value
+    if value.subtype != VECTOR_SUBTYPE:
+        raise ValueError(f"Not a vector, binary subtype {value.subtype}")
+
+    dtype = value[0]
+    if dtype == _FLOAT32:
+        return np.frombuffer(value, dtype="<f4", offset=2).tolist()
+    if dtype == _INT8:
+        return (np.frombuffer(value, dtype=np.int8, offset=2) / 127).tolist()
+    raise ValueError(f"Unsupported vector dtype {dtype:#x}")
+
+def encode_many(vectors, storage: str = None) -> list:
+    return [encode_vector(vector, storage) for vector in vectors]
+
+def decode_many(values) -> list[list[float]]:
+    return [decode_vector(value) for value in values]
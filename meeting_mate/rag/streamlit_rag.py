@@ -7,6 +7,7 @@ import meeting_mate.mongo.retrieval as retrieval
 from meeting_mate.llm.models import EmbeddingModels, EmbeddingsModel
 from langchain_core.messages import HumanMessage, SystemMessage
 from meeting_mate.llm.prompts import Templates
+from meeting_mate.llm.cache import AnswerCache
 import os
 import json
 from dotenv import load_dotenv
@@ -74,19 +75,53 @@ with headright:
     if selected_customer:
         st.session_state.customers.add(selected_customer)
 
-model = EmbeddingsModel(EmbeddingModels.NOMIC_EMBED_TEXT_1_5)
-retriever = retrieval.Retriever(colname="facts", embeddingModel=model, vector_index="vector_index", embedding_field="embedding", text_index="text_index", text_field="facts", user_field="user_id")
+# streamlit re-runs this script on every interaction, clients and caches are created once per process
+@st.cache_resource
+def get_retriever():
+    model = EmbeddingsModel(EmbeddingModels.NOMIC_EMBED_TEXT_1_5)
+    cache = retrieval.SearchCache().watch(mongo.db["facts"])
+
+    backend = None
+    if os.environ.get("vector_backend") == "local":
+        from meeting_mate.mongo.local_index import LocalVectorBackend
+        backend = LocalVectorBackend(mongo.db["facts"], embedding_field="embedding")
+    return retrieval.Retriever(colname="facts", embeddingModel=model, vector_index="vector_index", embedding_field="embedding", text_index="text_index", text_field="facts", user_field="user_id", backend=backend, cache=cache)
+
+CHAT_MODEL = ChatModels.LLAMA3_8B_INSTRUCT
+
+@st.cache_resource
+def get_chat_model():
+    return ChatModel(CHAT_MODEL)
+
+@st.cache_resource
+def get_answer_cache():
+    return AnswerCache(similarity_threshold=0.95)
+
+retriever = get_retriever()
 
 def generate_answer(search_results: list, question: str):
-    model = ChatModel(ChatModels.LLAMA3_8B_INSTRUCT)
+    purpose = "Document Q&A in streamlit"
+    orgs = list(st.session_state.customers)
+    answer_cache = get_answer_cache()
+
+    # already embedded for the search, served from the search cache
+    question_embedding = retriever.embed_query(question, purpose=purpose, user=user_id)
+    cached = answer_cache.get(CHAT_MODEL, user=user_id, orgs=orgs, facts=search_results, question=question, purpose=purpose, question_embedding=question_embedding)
+    if cached is not None:
+        yield cached
+        return
 
     facts = [result["facts"] for result in search_results]
     context = Templates.build_qa_context(facts, question)
 
     prompt = [SystemMessage(Templates.answer_question_system_prompt()), HumanMessage(context)]
-    
-    response = model.invoke(prompt, "Document Q&A in streamlit", user_id)
-    return response
+
+    # tokens are rendered as they arrive, the answer is cached once complete
+    chunks = []
+    for chunk in get_chat_model().stream(prompt, purpose, user_id):
+        chunks.append(chunk)
+        yield chunk
+    answer_cache.put(CHAT_MODEL, user=user_id, orgs=orgs, facts=search_results, question=question, answer="".join(chunks), question_embedding=question_embedding)
 
 if not st.session_state.customers:
     st.markdown("Please select customers to proceed.")
@@ -96,6 +131,8 @@ else:
     if question := st.chat_input("Ask a question about the selected customers"):
         left, right = st.columns(2)
         results, pipe = retriever.vector_search(question, purpose="Document Q&A in streamlit", top_k=10, user=user_id, orgs=list(st.session_state.customers))        
+        cache = retriever.cache
+        st.caption(f"Search cache: {cache.hits} hits, {cache.misses} misses ({cache.hit_rate:.0%} hit rate)")
 
         if not results or len(results) == 0:
             st.write(pipe)
@@ -113,6 +150,6 @@ else:
 
         right.markdown(f"Question: {question}")
 
-        st.spinner("Generating answer...")    
-        answer = generate_answer(results, question)        
-        right.markdown(answer)
\ No newline at end of file
+        answer = right.write_stream(generate_answer(results, question))
+        answer_cache = get_answer_cache()
+        right.caption(f"Answer cache: {answer_cache.hits} hits, {answer_cache.misses} misses ({answer_cache.hit_rate:.0%} hit rate)")
\ No newline at end of file